@@ -1,49 +1,556 @@
+import os
 import boto3
 import json
+import time
+import random
+import base64
+import threading
+from decimal import Decimal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
 
-# define the DynamoDB table that Lambda will connect to
-tableName = "lambda-apigateway"
+# define the DynamoDB table that Lambda will connect to, TABLENAME is set by the stack
+tableName = os.environ.get('TABLENAME', 'lambda-apigateway')
 
-# create the DynamoDB resource
-dynamo = boto3.resource('dynamodb').Table(tableName)
+# low-level DynamoDB client created on first use, the resource and its Table model are never loaded
+# short timeouts so a stuck connection is retried instead of eating the Lambda timeout
+# adaptive retries also rate limit the client while DynamoDB throttles
+# export AWS_ENDPOINT_URL_DYNAMODB='http://localhost:8000' to use DynamoDB Local
+dynamo = None
+dynamo_config = Config(
+    connect_timeout=float(os.environ.get('DDB_CONNECT_TIMEOUT', 1)),
+    read_timeout=float(os.environ.get('DDB_READ_TIMEOUT', 3)),
+    max_pool_connections=int(os.environ.get('DDB_MAX_POOL_CONNECTIONS', 25)),
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': int(os.environ.get('DDB_MAX_ATTEMPTS', 4))}
+)
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+# limits of BatchWriteItem and BatchGetItem
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+# retries of UnprocessedItems/UnprocessedKeys, exponential backoff with full jitter
+BATCH_RETRIES = 8
+BATCH_BACKOFF_BASE = 0.05
+BATCH_BACKOFF_MAX = 2
+# read-through cache of get_item kept by the container between warm invocations
+# at most CACHE_SIZE items (0 disables it) evicted by least recently used, every item is kept CACHE_TTL seconds
+# writes only invalidate the cache of the container handling them, other containers may serve an item up to CACHE_TTL seconds old
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 1024))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 60))
+# query and scan stop at a page boundary before the response gets over RESPONSE_MAX_BYTES (the Lambda response limit is 6MB)
+# or when less than TIME_MARGIN_MS of the invocation is left, TIME_BUDGET seconds at most
+RESPONSE_MAX_BYTES = int(os.environ.get('RESPONSE_MAX_BYTES', 5 * 1024 * 1024))
+TIME_MARGIN_MS = int(os.environ.get('TIME_MARGIN_MS', 1000))
+TIME_BUDGET = float(os.environ.get('TIME_BUDGET', 25))
+# threads of a parallel scan, keep it under DDB_MAX_POOL_CONNECTIONS
+SCAN_WORKERS = int(os.environ.get('SCAN_WORKERS', 8))
+# a page of query or scan is at most 1MB
+PAGE_MAX_BYTES = 1024 * 1024
+
+class ItemCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # returns (True, item) on a hit, item is None for a key known to be missing
+        entry = self.items.get(key)
+        if entry == None or entry[0] < time.monotonic():
+            if entry != None:
+                del self.items[key]
+            self.misses += 1
+            return False, None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, key, item):
+        if self.size <= 0:
+            return
+        self.items[key] = (time.monotonic() + self.ttl, item)
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def invalidate(self, key):
+        self.items.pop(key, None)
+
+cache = ItemCache(CACHE_SIZE, CACHE_TTL)
+
+def get_dynamo():
+    global dynamo
+    if dynamo == None:
+        dynamo = boto3.client('dynamodb', config=dynamo_config)
+    return dynamo
+# key attributes of the table, read once per container
+key_attributes = None
 
 print('Loading function')
 
+def chunks(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+def key_id(key):
+    # the same key from json (int/float) or from DynamoDB (Decimal) gives the same id
+    return json.dumps(to_json(key), sort_keys=True, default=str)
+
+def unique_keys(keys):
+    # the batch operations reject the same key twice on one request
+    seen = {}
+    for key in keys:
+        seen.setdefault(key_id(key), key)
+    return list(seen.values())
+
+def unique_items(items):
+    # the same key twice on one BatchWriteItem is rejected, the last item of a key wins like consecutive puts
+    names = table_keys()
+    seen = {}
+    for item in items:
+        seen[key_id({name: item[name] for name in names})] = item
+    return list(seen.values())
+
+def table_keys():
+    # export KEY_ATTRIBUTES='id' to skip the DescribeTable of the first write, recommended
+    # without it the role also needs dynamodb:DescribeTable, the callers keep working when it is denied
+    global key_attributes
+    if key_attributes == None:
+        names = os.environ.get('KEY_ATTRIBUTES', None)
+        if names:
+            key_attributes = [name.strip() for name in names.split(',')]
+        else:
+            table = get_dynamo().describe_table(TableName=tableName)['Table']
+            key_attributes = [key['AttributeName'] for key in table['KeySchema']]
+    return key_attributes
+
+def invalidate_items(items):
+    # the key schema is only needed when something is cached
+    # runs after the write, an error reading the key schema must not turn a successful write into an error
+    # so the whole cache is dropped instead, no stale item is served
+    if not cache.items:
+        return
+    try:
+        names = table_keys()
+    except Exception as e:
+        print('Error Reading key attributes, cache cleared : {}'.format(e))
+        cache.items.clear()
+        return
+    for item in items:
+        cache.invalidate(key_id({name: item[name] for name in names if name in item}))
+
+def backoff(attempt):
+    time.sleep(random.uniform(0, min(BATCH_BACKOFF_MAX, BATCH_BACKOFF_BASE * 2 ** attempt)))
+
+def from_json(value):
+    # json numbers with a fraction are float, DynamoDB only takes Decimal
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {key: from_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_json(item) for item in value]
+    return value
+
+def to_ddb(item):
+    # plain values to DynamoDB attribute values
+    return {name: serializer.serialize(value) for name, value in item.items()}
+
+def from_ddb(item):
+    # DynamoDB attribute values to plain values (numbers as Decimal)
+    return {name: deserializer.deserialize(value) for name, value in item.items()}
+
+def ddb_request(x):
+    # payloads have plain values like the Table resource, the client takes attribute values
+    request = dict(from_json(x), TableName=tableName)
+    for name in ('Item', 'Key', 'ExpressionAttributeValues', 'ExclusiveStartKey'):
+        if name in request:
+            request[name] = to_ddb(request[name])
+    return request
+
+def to_json(value):
+    # numbers come from DynamoDB as Decimal and sets as set, the Lambda response must be plain json
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {key: to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, set, tuple)):
+        return [to_json(item) for item in value]
+    return value
+
+def batch_write(requests):
+    '''Send PutRequest/DeleteRequest entries in BatchWriteItem batches of 25.
+
+    The entries have attribute values. UnprocessedItems are sent again with
+    backoff, returns the number of requests written and the requests still
+    unprocessed after BATCH_RETRIES.
+    '''
+    client = get_dynamo()
+    written = 0
+    unprocessed = []
+    for pending in chunks(requests, BATCH_WRITE_SIZE):
+        attempt = 0
+        while pending:
+            response = client.batch_write_item(RequestItems={tableName: pending})
+            left = response.get('UnprocessedItems', {}).get(tableName, [])
+            written += len(pending) - len(left)
+            pending = left
+            if pending:
+                if attempt >= BATCH_RETRIES:
+                    unprocessed.extend(pending)
+                    break
+                backoff(attempt)
+                attempt += 1
+    return written, unprocessed
+
+def batch_get(keys, options=None):
+    '''Read keys in BatchGetItem batches of 100.
+
+    options are the ProjectionExpression, ExpressionAttributeNames and
+    ConsistentRead of every batch. UnprocessedKeys are read again with
+    backoff, returns the items found and the keys still unprocessed, both
+    with plain values.
+    '''
+    client = get_dynamo()
+    items = []
+    unprocessed = []
+    for batch in chunks(unique_keys(keys), BATCH_GET_SIZE):
+        request = dict(options or {}, Keys=[to_ddb(key) for key in batch])
+        attempt = 0
+        while True:
+            response = client.batch_get_item(RequestItems={tableName: request})
+            items.extend(from_ddb(item) for item in response.get('Responses', {}).get(tableName, []))
+            left = response.get('UnprocessedKeys', {}).get(tableName)
+            if not left or not left.get('Keys'):
+                break
+            if attempt >= BATCH_RETRIES:
+                unprocessed.extend(from_ddb(key) for key in left['Keys'])
+                break
+            backoff(attempt)
+            attempt += 1
+            request = left
+    return items, unprocessed
+
+class Budget:
+    # response size and time left for one query or scan, shared by the segments of a parallel scan
+    # a page is only started when a whole page still fits, the first page is always read
+    def __init__(self, context, max_bytes=None):
+        seconds = TIME_BUDGET
+        if context != None:
+            seconds = min(seconds, (context.get_remaining_time_in_millis() - TIME_MARGIN_MS) / 1000)
+        self.deadline = time.monotonic() + seconds
+        self.max_bytes = max_bytes or RESPONSE_MAX_BYTES
+        self.spent = 0
+        self.reserved = 0
+        self.pages = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            if self.pages > 0:
+                if time.monotonic() >= self.deadline or self.spent + self.reserved + PAGE_MAX_BYTES > self.max_bytes:
+                    return False
+            self.pages += 1
+            self.reserved += PAGE_MAX_BYTES
+            return True
+
+    def spend(self, size):
+        with self.lock:
+            self.reserved -= PAGE_MAX_BYTES
+            self.spent += size
+
+def encode_cursor(keys):
+    # one entry per segment, null: not started, false: finished, key: resume after it
+    if all(key is False for key in keys):
+        return None
+    keys = [
+        {name: {'B': base64.b64encode(value['B']).decode()} if 'B' in value else value for name, value in key.items()}
+        if isinstance(key, dict) else key
+        for key in keys
+    ]
+    return base64.urlsafe_b64encode(json.dumps(keys, separators=(',', ':')).encode()).decode()
+
+def decode_cursor(cursor, segments):
+    if cursor == None:
+        return [None] * segments
+    keys = json.loads(base64.urlsafe_b64decode(cursor))
+    if len(keys) != segments:
+        raise ValueError('Cursor of {} segments used with TotalSegments {}'.format(len(keys), segments))
+    return [
+        {name: {'B': base64.b64decode(value['B'])} if 'B' in value else value for name, value in key.items()}
+        if isinstance(key, dict) else key
+        for key in keys
+    ]
+
+def read_pages(method, request, start, budget):
+    '''Follow LastEvaluatedKey from start until the last page or the budget.
+
+    Returns the items, the scanned count and the key to resume from, False
+    when the last page was read.
+    '''
+    items = []
+    scanned = 0
+    while True:
+        if not budget.reserve():
+            return items, scanned, start
+        page = dict(request, ExclusiveStartKey=start) if start else request
+        size = 0
+        try:
+            response = method(**page)
+            size = response['ResponseMetadata'].get('HTTPHeaders', {}).get('content-length')
+            # the typed json of the page is larger than the plain json returned
+            size = int(size) if size != None else len(json.dumps(response.get('Items', []), default=str))
+        finally:
+            budget.spend(size)
+        items.extend(from_ddb(item) for item in response.get('Items', []))
+        scanned += response.get('ScannedCount', 0)
+        start = response.get('LastEvaluatedKey')
+        if start == None:
+            return items, scanned, False
+
+def paginate(method, x, context, segments=1):
+    '''Run a query or scan from the Cursor of the payload within the budget.
+
+    With more than one segment the scan is split by Segment/TotalSegments
+    on SCAN_WORKERS threads. Returns the items and the Cursor to send back
+    for the next items, None after the last page.
+    '''
+    if segments < 1:
+        raise ValueError('TotalSegments must be at least 1, got {}'.format(segments))
+    request = ddb_request({name: value for name, value in x.items() if name not in ('Cursor', 'TotalSegments', 'Segment', 'MaxBytes')})
+    keys = decode_cursor(x.get('Cursor'), segments)
+    budget = Budget(context, x.get('MaxBytes'))
+
+    def read_segment(segment):
+        if keys[segment] is False:
+            return [], 0, False
+        if segments > 1:
+            return read_pages(method, dict(request, Segment=segment, TotalSegments=segments), keys[segment], budget)
+        return read_pages(method, request, keys[segment], budget)
+
+    if segments > 1:
+        with ThreadPoolExecutor(max_workers=min(segments, SCAN_WORKERS)) as executor:
+            results = list(executor.map(read_segment, range(segments)))
+    else:
+        results = [read_segment(0)]
+    items = [item for result in results for item in result[0]]
+    return to_json({
+        'Items': items,
+        'Count': len(items),
+        'ScannedCount': sum(result[1] for result in results),
+        'Cursor': encode_cursor([result[2] for result in results])
+    })
+
+def sqs_batch(records, operations):
+    '''Run the {operation, payload} messages of an SQS batch.
+
+    On standard queues the consecutive create and delete messages are
+    written together in BatchWriteItem batches, they are flushed before any
+    other operation so the messages keep their order. FIFO queues run every
+    message one by one and stop at the first failure. Returns the
+    batchItemFailures so only the failed messages are retried, the event
+    source mapping needs ReportBatchItemFailures.
+    '''
+    failures = []
+    fifo = bool(records) and records[0].get('eventSourceARN', '').endswith('.fifo')
+    # key id -> write request and the ids of the messages writing that key, the last message of a key wins
+    writes = {}
+    # key attributes of the bulk creates, read on the first one, None when they can not be read
+    names = False
+
+    def create_keys():
+        nonlocal names
+        if names is False:
+            try:
+                names = table_keys()
+            except Exception as e:
+                # the creates run one by one, like on FIFO queues
+                print('Error Reading key attributes, creates are not batched : {}'.format(e))
+                names = None
+        return names
+
+    def flush():
+        if not writes:
+            return
+        try:
+            written, unprocessed = batch_write([request for request, message_ids in writes.values()])
+        except Exception as e:
+            # puts and deletes can be sent again
+            print('Error Writing {} keys : {}'.format(len(writes), e))
+            unprocessed = [request for request, message_ids in writes.values()]
+        finally:
+            for key in writes:
+                cache.invalidate(key)
+        for request in unprocessed:
+            if 'PutRequest' in request:
+                item = from_ddb(request['PutRequest']['Item'])
+                key = {name: item[name] for name in names}
+            else:
+                key = from_ddb(request['DeleteRequest']['Key'])
+            failures.extend(writes[key_id(key)][1])
+        writes.clear()
+
+    for position, record in enumerate(records):
+        message_id = record['messageId']
+        try:
+            message = json.loads(record['body'])
+            operation = message['operation']
+            payload = message.get('payload')
+            if operation not in operations:
+                raise ValueError('Unrecognized operation "{}"'.format(operation))
+            if not fifo and operation == 'create' and list(payload) == ['Item'] and create_keys() != None:
+                item = from_json(payload['Item'])
+                key = key_id({name: item[name] for name in names})
+                request = {'PutRequest': {'Item': to_ddb(item)}}
+            elif not fifo and operation == 'delete' and list(payload) == ['Key']:
+                key = key_id(payload['Key'])
+                request = {'DeleteRequest': {'Key': to_ddb(from_json(payload['Key']))}}
+            else:
+                flush()
+                operations[operation](payload)
+                continue
+            writes[key] = (request, writes.get(key, (None, []))[1] + [message_id])
+        except Exception as e:
+            print('Error Processing message {} : {}'.format(message_id, e))
+            if fifo:
+                # later messages of the group must not run before this one
+                return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in records[position:]]}
+            failures.append(message_id)
+    flush()
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
+
 def handler(event, context):
     '''Provide an event that contains the following keys:
 
       - operation: one of the operations in the operations dict below
-      - payload: a JSON object containing parameters to pass to the 
+      - payload: a JSON object containing parameters to pass to the
                  operation being performed
+
+    read returns the item (None when it does not exist), add
+    "ConsistentRead": true to the payload to bypass the cache.
+
+    The batch operations take a list on the payload:
+
+      - batch_create: {"Items": [item, ...]}, the last item of a repeated key
+                      is written
+      - batch_read: {"Keys": [key, ...]} with optional ProjectionExpression,
+                    ExpressionAttributeNames and ConsistentRead
+      - batch_delete: {"Keys": [key, ...]}
+
+    query and scan take the parameters of Query/Scan (KeyConditionExpression,
+    FilterExpression, ProjectionExpression, IndexName, Limit, ...). Send the
+    returned Cursor back to read the next items, scan with TotalSegments
+    reads the segments in parallel. MaxBytes lowers RESPONSE_MAX_BYTES.
+
+    An SQS event (Records) runs the same {operation, payload} sent as the
+    body of every message, see sqs_batch.
     '''
-    
+
     # define the functions used to perform the CRUD operations
+    # reads go through the cache of the container, ConsistentRead skips it and refreshes the item
     def ddb_create(x):
-        dynamo.put_item(**x)
+        try:
+            get_dynamo().put_item(**ddb_request(x))
+        finally:
+            invalidate_items([x['Item']])
 
     def ddb_read(x):
-        dynamo.get_item(**x)
+        key = key_id(x['Key'])
+        # projected reads are not cached, the cached item must be the whole item
+        cacheable = 'ProjectionExpression' not in x and 'AttributesToGet' not in x
+        if cacheable and not x.get('ConsistentRead'):
+            hit, item = cache.get(key)
+            if hit:
+                return to_json(item)
+        item = get_dynamo().get_item(**ddb_request(x)).get('Item')
+        if item != None:
+            item = from_ddb(item)
+        if cacheable:
+            cache.put(key, item)
+        return to_json(item)
 
     def ddb_update(x):
-        dynamo.update_item(**x)
-        
+        try:
+            get_dynamo().update_item(**ddb_request(x))
+        finally:
+            cache.invalidate(key_id(x['Key']))
+
     def ddb_delete(x):
-        dynamo.delete_item(**x)
+        try:
+            get_dynamo().delete_item(**ddb_request(x))
+        finally:
+            cache.invalidate(key_id(x['Key']))
+
+    def ddb_batch_create(x):
+        items = from_json(x['Items'])
+        try:
+            items = unique_items(items)
+        except Exception as e:
+            # DynamoDB rejects the batches with a repeated key by itself
+            print('Error Reading key attributes, items not deduplicated : {}'.format(e))
+        try:
+            written, unprocessed = batch_write([{'PutRequest': {'Item': to_ddb(item)}} for item in items])
+        finally:
+            invalidate_items(items)
+        return to_json({
+            'Written': written,
+            'UnprocessedItems': [from_ddb(request['PutRequest']['Item']) for request in unprocessed]
+        })
+
+    def ddb_batch_read(x):
+        options = {name: x[name] for name in ('ProjectionExpression', 'ExpressionAttributeNames', 'ConsistentRead') if name in x}
+        items, unprocessed = batch_get(from_json(x['Keys']), options)
+        return to_json({
+            'Items': items,
+            'Count': len(items),
+            'UnprocessedKeys': unprocessed
+        })
+
+    def ddb_batch_delete(x):
+        keys = unique_keys(from_json(x['Keys']))
+        try:
+            deleted, unprocessed = batch_write([{'DeleteRequest': {'Key': to_ddb(key)}} for key in keys])
+        finally:
+            for key in keys:
+                cache.invalidate(key_id(key))
+        return to_json({
+            'Deleted': deleted,
+            'UnprocessedKeys': [from_ddb(request['DeleteRequest']['Key']) for request in unprocessed]
+        })
+
+    def ddb_query(x):
+        return paginate(get_dynamo().query, x, context)
+
+    def ddb_scan(x):
+        return paginate(get_dynamo().scan, x, context, int(x.get('TotalSegments', 1)))
 
     def echo(x):
         return x
 
-    operation = event['operation']
-
     operations = {
         'create': ddb_create,
         'read': ddb_read,
         'update': ddb_update,
         'delete': ddb_delete,
+        'batch_create': ddb_batch_create,
+        'batch_read': ddb_batch_read,
+        'batch_delete': ddb_batch_delete,
+        'query': ddb_query,
+        'scan': ddb_scan,
         'echo': echo,
     }
 
+    if 'Records' in event:
+        return sqs_batch(event['Records'], operations)
+
+    operation = event['operation']
     if operation in operations:
         return operations[operation](event.get('payload'))
     else:
-        raise ValueError('Unrecognized operation "{}"'.format(operation))
\ No newline at end of file
+        raise ValueError('Unrecognized operation "{}"'.format(operation))
@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import statistics
+
+# local benchmark of the DynamoDB handler against moto server or DynamoDB Local, no AWS account needed
+# cold: a new process per run timing the import of index.py, the client creation and the first call
+# warm: per operation latency of the handler on one process, like a warm Lambda container
+#
+# python bench.py --runs 5 --operations 200
+# python bench.py --endpoint http://localhost:8000 # DynamoDB Local
+# python bench.py --output current.json --baseline previous.json --tolerance 0.2
+
+__dirname = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(__dirname, '..', 'apigw_sample', 'functions', 'Myfunction', 'src')
+TABLE = 'lambda-apigateway-bench'
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_moto():
+    import logging
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    return server, f"http://127.0.0.1:{port}"
+
+def create_table(endpoint):
+    import boto3
+    client = boto3.client('dynamodb', endpoint_url=endpoint)
+    if TABLE in client.list_tables()['TableNames']:
+        return
+    client.create_table(
+        TableName=TABLE,
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    client.get_waiter('table_exists').wait(TableName=TABLE)
+
+def run_cold():
+    # runs on its own process, the environment points the handler to the local endpoint
+    start = time.perf_counter()
+    sys.path.insert(0, SRC)
+    import index
+    imported = time.perf_counter()
+    index.get_dynamo()
+    client = time.perf_counter()
+    index.handler({'operation': 'read', 'payload': {'Key': {'id': 'cold'}}}, None)
+    first = time.perf_counter()
+    return {
+        "import_ms": round((imported - start) * 1000, 2),
+        "client_ms": round((client - imported) * 1000, 2),
+        "first_call_ms": round((first - client) * 1000, 2),
+        "init_ms": round((first - start) * 1000, 2)
+    }
+
+def run_warm(operations):
+    sys.path.insert(0, SRC)
+    import index
+
+    def call(operation, payload):
+        return index.handler({'operation': operation, 'payload': payload}, None)
+
+    # the first call creates the client and its connection
+    call('read', {'Key': {'id': 'warmup'}})
+    keys = [f"key-{number}" for number in range(operations)]
+    cases = [
+        ('create', lambda key: call('create', {'Item': {'id': key, 'value': 1, 'name': key}})),
+        ('read', lambda key: call('read', {'Key': {'id': key}, 'ConsistentRead': True})),
+        ('read_cached', lambda key: call('read', {'Key': {'id': key}})),
+        ('update', lambda key: call('update', {'Key': {'id': key}, 'UpdateExpression': 'SET #v = #v + :one', 'ExpressionAttributeNames': {'#v': 'value'}, 'ExpressionAttributeValues': {':one': 1}})),
+        ('delete', lambda key: call('delete', {'Key': {'id': key}})),
+        ('batch_create_25', lambda key: call('batch_create', {'Items': [{'id': f"{key}-{number}", 'value': number} for number in range(25)]})),
+        ('batch_read_100', lambda key: call('batch_read', {'Keys': [{'id': f"{key}-{number}"} for number in range(100)]}))
+    ]
+    results = {}
+    for name, case in cases:
+        latencies = []
+        for key in keys:
+            start = time.perf_counter()
+            case(key)
+            latencies.append(time.perf_counter() - start)
+        results[name] = {
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3)
+        }
+    # the cache warmed by read is cleared by update and delete
+    results["cache"] = {"hits": index.cache.hits, "misses": index.cache.misses}
+    return results
+
+def compare(results, baseline, tolerance):
+    # fails when a median latency grew more than tolerance from the baseline
+    regressions = []
+    current = flatten(results)
+    for name, value in flatten(baseline).items():
+        if not name.endswith('_ms') or name not in current or name.endswith('p99_ms'):
+            continue
+        allowed = value * (1 + tolerance)
+        if current[name] > allowed:
+            regressions.append(f"{name}: {current[name]} ms is above {round(allowed, 3)} ms")
+    return regressions
+
+def flatten(results, prefix=''):
+    values = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{name}."))
+        else:
+            values[f"{prefix}{name}"] = value
+    return values
+
+def print_table(results):
+    print("cold | import_ms | client_ms | first_call_ms | init_ms")
+    print(" | ".join(['median'] + [str(results['cold'][column]) for column in ['import_ms', 'client_ms', 'first_call_ms', 'init_ms']]))
+    print("\nwarm | p50_ms | p95_ms | p99_ms")
+    for name, result in results['warm'].items():
+        if name != 'cache':
+            print(" | ".join([name, str(result['p50_ms']), str(result['p95_ms']), str(result['p99_ms'])]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Local benchmark of the DynamoDB handler")
+    parser.add_argument('--endpoint', default=None, help="DynamoDB Local endpoint, a moto server is started when not set")
+    parser.add_argument('--runs', type=int, default=5, help="cold start processes")
+    parser.add_argument('--operations', type=int, default=200, help="calls per warm operation")
+    parser.add_argument('--output', help="write the results to this json file")
+    parser.add_argument('--baseline', help="json results of a previous run to compare")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed latency growth from the baseline")
+    # internal options used to run a cold start on its own process
+    parser.add_argument('--cold', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--warm', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold:
+        print(json.dumps(run_cold()))
+        return
+    if args.warm:
+        print(json.dumps(run_warm(args.operations)))
+        return
+
+    server = None
+    endpoint = args.endpoint
+    if endpoint == None:
+        server, endpoint = start_moto()
+    # the handler finds the endpoint and the table on the environment, like on Lambda
+    env = dict(os.environ)
+    env.update({
+        'AWS_ENDPOINT_URL_DYNAMODB': endpoint,
+        'TABLENAME': TABLE,
+        'KEY_ATTRIBUTES': 'id',
+        'AWS_DEFAULT_REGION': env.get('AWS_DEFAULT_REGION', 'us-east-1'),
+        'AWS_ACCESS_KEY_ID': env.get('AWS_ACCESS_KEY_ID', 'bench'),
+        'AWS_SECRET_ACCESS_KEY': env.get('AWS_SECRET_ACCESS_KEY', 'bench')
+    })
+    os.environ.update(env)
+    try:
+        create_table(endpoint)
+        cold = []
+        for run in range(args.runs):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--cold'], capture_output=True, text=True, env=env)
+            if output.returncode != 0:
+                sys.exit(f"Error Running cold start:\n{output.stderr}")
+            cold.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--warm', '--operations', str(args.operations)], capture_output=True, text=True, env=env)
+        if output.returncode != 0:
+            sys.exit(f"Error Running warm operations:\n{output.stderr}")
+        warm = json.loads(output.stdout.strip().splitlines()[-1])
+    finally:
+        if server != None:
+            server.stop()
+    results = {
+        "cold": {name: round(statistics.median(run[name] for run in cold), 2) for name in cold[0]},
+        "warm": warm
+    }
+    print_table(results)
+    if args.output != None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline != None:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit("Regressions found:\n" + "\n".join(regressions))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+import os
+import sys
+import json
+import subprocess
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# the handler is a Lambda asset, not a package
+SRC = os.path.join(os.path.dirname(__file__), '..', '..', 'apigw_sample', 'functions', 'Myfunction', 'src')
+sys.path.insert(0, SRC)
+import index
+
+TABLE = 'lambda-apigateway-test'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('KEY_ATTRIBUTES', 'id')
+    with mock_aws():
+        boto3.client('dynamodb').create_table(
+            TableName=TABLE,
+            KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        # every test gets its own client, key schema and cache
+        monkeypatch.setattr(index, 'tableName', TABLE)
+        monkeypatch.setattr(index, 'dynamo', None)
+        monkeypatch.setattr(index, 'key_attributes', None)
+        monkeypatch.setattr(index, 'cache', index.ItemCache(16, 60))
+        monkeypatch.setattr(index, 'backoff', lambda attempt: None)
+        yield index.get_dynamo()
+
+
+def call(operation, payload):
+    return index.handler({'operation': operation, 'payload': payload}, None)
+
+
+def table_ids(client):
+    return sorted(item['id']['S'] for item in client.scan(TableName=TABLE)['Items'])
+
+
+def test_batch_create_in_batches_of_25(client, monkeypatch):
+    sizes = []
+    batch_write_item = client.batch_write_item
+
+    def recorded(RequestItems):
+        sizes.append(len(RequestItems[TABLE]))
+        return batch_write_item(RequestItems=RequestItems)
+
+    monkeypatch.setattr(client, 'batch_write_item', recorded)
+    result = call('batch_create', {'Items': [{'id': 'k{}'.format(number), 'value': 1.5} for number in range(60)]})
+    assert result == {'Written': 60, 'UnprocessedItems': []}
+    assert sizes == [25, 25, 10]
+    assert len(table_ids(client)) == 60
+
+
+def test_batch_create_keeps_last_item_of_a_key(client):
+    result = call('batch_create', {'Items': [{'id': 'a', 'value': 1}, {'id': 'b'}, {'id': 'a', 'value': 2}]})
+    assert result == {'Written': 2, 'UnprocessedItems': []}
+    assert call('read', {'Key': {'id': 'a'}}) == {'id': 'a', 'value': 2}
+
+
+def test_batch_create_retries_unprocessed_items(client, monkeypatch):
+    calls = []
+    batch_write_item = client.batch_write_item
+
+    def partial(RequestItems):
+        # writes the first request of every call, the others come back unprocessed
+        requests = RequestItems[TABLE]
+        calls.append(len(requests))
+        response = batch_write_item(RequestItems={TABLE: requests[:1]})
+        if requests[1:]:
+            response['UnprocessedItems'] = {TABLE: requests[1:]}
+        return response
+
+    monkeypatch.setattr(client, 'batch_write_item', partial)
+    result = call('batch_create', {'Items': [{'id': 'k{}'.format(number)} for number in range(5)]})
+    assert result == {'Written': 5, 'UnprocessedItems': []}
+    assert calls == [5, 4, 3, 2, 1]
+    assert len(table_ids(client)) == 5
+
+
+def test_batch_create_returns_items_unprocessed_after_retries(client, monkeypatch):
+    monkeypatch.setattr(index, 'BATCH_RETRIES', 2)
+    calls = []
+
+    def throttled(RequestItems):
+        calls.append(len(RequestItems[TABLE]))
+        return {'UnprocessedItems': RequestItems}
+
+    monkeypatch.setattr(client, 'batch_write_item', throttled)
+    result = call('batch_create', {'Items': [{'id': 'a', 'value': 1}]})
+    assert result == {'Written': 0, 'UnprocessedItems': [{'id': 'a', 'value': 1}]}
+    assert calls == [1, 1, 1]
+
+
+def test_batch_read_and_delete_in_batches(client, monkeypatch):
+    sizes = []
+    batch_get_item = client.batch_get_item
+
+    def recorded(RequestItems):
+        sizes.append(len(RequestItems[TABLE]['Keys']))
+        return batch_get_item(RequestItems=RequestItems)
+
+    monkeypatch.setattr(client, 'batch_get_item', recorded)
+    call('batch_create', {'Items': [{'id': 'k{}'.format(number)} for number in range(150)]})
+    keys = [{'id': 'k{}'.format(number)} for number in range(150)] + [{'id': 'k0'}, {'id': 'missing'}]
+    result = call('batch_read', {'Keys': keys})
+    assert result['Count'] == 150 and result['UnprocessedKeys'] == []
+    # the repeated key is read once
+    assert sizes == [100, 51]
+    result = call('batch_delete', {'Keys': keys})
+    assert result == {'Deleted': 151, 'UnprocessedKeys': []}
+    assert table_ids(client) == []
+
+
+def test_update_invalidates_cached_read(client):
+    call('create', {'Item': {'id': 'a', 'value': 1}})
+    assert call('read', {'Key': {'id': 'a'}}) == {'id': 'a', 'value': 1}
+    # a write outside the handler is not seen while the item is cached
+    client.put_item(TableName=TABLE, Item={'id': {'S': 'a'}, 'value': {'N': '5'}})
+    assert call('read', {'Key': {'id': 'a'}}) == {'id': 'a', 'value': 1}
+    call('update', {
+        'Key': {'id': 'a'},
+        'UpdateExpression': 'SET #v = #v + :one',
+        'ExpressionAttributeNames': {'#v': 'value'},
+        'ExpressionAttributeValues': {':one': 1}
+    })
+    assert call('read', {'Key': {'id': 'a'}}) == {'id': 'a', 'value': 6}
+    call('delete', {'Key': {'id': 'a'}})
+    assert call('read', {'Key': {'id': 'a'}}) == None
+
+
+def test_consistent_read_bypasses_and_refreshes_the_cache(client):
+    call('create', {'Item': {'id': 'a', 'value': 1}})
+    assert call('read', {'Key': {'id': 'a'}}) == {'id': 'a', 'value': 1}
+    client.put_item(TableName=TABLE, Item={'id': {'S': 'a'}, 'value': {'N': '2'}})
+    assert call('read', {'Key': {'id': 'a'}, 'ConsistentRead': True}) == {'id': 'a', 'value': 2}
+    # the cached item was refreshed by the consistent read, only the last read is served by the cache
+    assert call('read', {'Key': {'id': 'a'}}) == {'id': 'a', 'value': 2}
+    assert index.cache.hits == 1
+
+
+def test_missing_item_is_cached(client):
+    assert call('read', {'Key': {'id': 'a'}}) == None
+    client.put_item(TableName=TABLE, Item={'id': {'S': 'a'}})
+    assert call('read', {'Key': {'id': 'a'}}) == None
+    call('create', {'Item': {'id': 'a', 'value': 1}})
+    assert call('read', {'Key': {'id': 'a'}}) == {'id': 'a', 'value': 1}
+
+
+def test_cache_evicts_least_recently_used_and_expires(client, monkeypatch):
+    monkeypatch.setattr(index, 'cache', index.ItemCache(2, 60))
+    for name in ('a', 'b', 'c'):
+        call('create', {'Item': {'id': name}})
+    call('read', {'Key': {'id': 'a'}})
+    call('read', {'Key': {'id': 'b'}})
+    call('read', {'Key': {'id': 'a'}})
+    call('read', {'Key': {'id': 'c'}})
+    # b was the least recently used
+    assert [index.cache.get(index.key_id({'id': name}))[0] for name in ('a', 'b', 'c')] == [True, False, True]
+    monkeypatch.setattr(index, 'cache', index.ItemCache(2, -1))
+    call('read', {'Key': {'id': 'a'}})
+    assert index.cache.get(index.key_id({'id': 'a'})) == (False, None)
+
+
+def test_create_succeeds_when_key_schema_is_denied(client, monkeypatch):
+    monkeypatch.delenv('KEY_ATTRIBUTES')
+
+    def denied(**kwargs):
+        raise Exception('AccessDeniedException')
+
+    monkeypatch.setattr(client, 'describe_table', denied)
+    call('create', {'Item': {'id': 'a', 'value': 1}})
+    assert call('read', {'Key': {'id': 'a'}}) == {'id': 'a', 'value': 1}
+    call('create', {'Item': {'id': 'a', 'value': 2}})
+    assert call('read', {'Key': {'id': 'a'}}) == {'id': 'a', 'value': 2}
+
+
+def test_table_name_from_environment_and_no_client_on_import():
+    code = 'import index; print(index.tableName, index.dynamo)'
+    output = subprocess.run(
+        [sys.executable, '-c', code], cwd=SRC, env=dict(os.environ, TABLENAME='from-stack'),
+        capture_output=True, text=True, check=True
+    )
+    assert output.stdout.splitlines()[-1] == 'from-stack None'
+
+
+def test_client_is_created_once_with_the_tuned_config(client):
+    assert index.get_dynamo() is client
+    config = client.meta.config
+    assert config.retries['mode'] == 'adaptive'
+    assert config.tcp_keepalive
+    assert config.connect_timeout == index.dynamo_config.connect_timeout
+    call('create', {'Item': {'id': 'a'}})
+    assert index.get_dynamo() is client
+    assert table_ids(client) == ['a']
+
+
+def test_scan_cursor_round_trip_with_segments(client):
+    call('batch_create', {'Items': [{'id': 'k{}'.format(number)} for number in range(40)]})
+    payload = {'TotalSegments': 4, 'Limit': 3, 'MaxBytes': 1}
+    seen = []
+    calls = 0
+    while True:
+        result = call('scan', payload)
+        seen.extend(item['id'] for item in result['Items'])
+        calls += 1
+        if result['Cursor'] == None:
+            break
+        payload = dict(payload, Cursor=result['Cursor'])
+    # MaxBytes lets a single page through on every call
+    assert calls > 4
+    assert sorted(seen) == sorted('k{}'.format(number) for number in range(40))
+
+
+def test_scan_cursor_of_other_segments_is_rejected(client):
+    call('batch_create', {'Items': [{'id': 'k{}'.format(number)} for number in range(10)]})
+    result = call('scan', {'TotalSegments': 2, 'Limit': 1, 'MaxBytes': 1})
+    assert result['Cursor'] != None
+    with pytest.raises(ValueError):
+        call('scan', {'TotalSegments': 3, 'Cursor': result['Cursor']})
+
+
+@pytest.mark.parametrize('segments', [0, -1])
+def test_scan_rejects_total_segments_under_one(client, segments):
+    with pytest.raises(ValueError):
+        call('scan', {'TotalSegments': segments})
+
+
+@pytest.fixture
+def events(client, monkeypatch):
+    client.create_table(
+        TableName='events',
+        KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}, {'AttributeName': 'sk', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}, {'AttributeName': 'sk', 'AttributeType': 'N'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    monkeypatch.setattr(index, 'tableName', 'events')
+    monkeypatch.setenv('KEY_ATTRIBUTES', 'pk,sk')
+    items = [{'pk': 'a', 'sk': number, 'size': 'x' * 10} for number in range(30)] + [{'pk': 'b', 'sk': 0}]
+    call('batch_create', {'Items': items})
+    return client
+
+
+class Context:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def query(payload, context=None):
+    return index.handler({'operation': 'query', 'payload': payload}, context)
+
+
+def test_query_follows_cursor_with_filter_and_projection(events):
+    payload = {
+        'KeyConditionExpression': 'pk = :pk AND sk >= :from',
+        'FilterExpression': 'sk < :to',
+        'ProjectionExpression': 'pk, sk',
+        'ExpressionAttributeValues': {':pk': 'a', ':from': 5, ':to': 25},
+        'Limit': 4,
+        'MaxBytes': 1
+    }
+    seen = []
+    while True:
+        result = query(payload)
+        seen.extend(result['Items'])
+        if result['Cursor'] == None:
+            break
+        payload = dict(payload, Cursor=result['Cursor'])
+    assert [item['sk'] for item in seen] == list(range(5, 25))
+    assert all(sorted(item) == ['pk', 'sk'] for item in seen)
+
+
+def test_query_stops_on_the_time_budget(events):
+    payload = {'KeyConditionExpression': 'pk = :pk', 'ExpressionAttributeValues': {':pk': 'a'}, 'Limit': 5}
+    # without time left only the first page is read
+    result = query(payload, Context(index.TIME_MARGIN_MS))
+    assert result['Count'] == 5 and result['Cursor'] != None
+    result = query(payload, Context(60000))
+    assert result['Count'] == 30 and result['Cursor'] == None
+
+
+def record(message_id, operation, payload, queue='queue'):
+    return {
+        'messageId': message_id,
+        'body': json.dumps({'operation': operation, 'payload': payload}),
+        'eventSourceARN': 'arn:aws:sqs:us-east-1:123456789012:{}'.format(queue)
+    }
+
+
+def failures(response):
+    return [failure['itemIdentifier'] for failure in response['batchItemFailures']]
+
+
+def test_sqs_standard_queue_reports_only_failed_messages(client, monkeypatch):
+    batch_write_item = client.batch_write_item
+
+    def throttle_b(RequestItems):
+        # the put of b is never processed
+        requests = [request for request in RequestItems[TABLE] if request.get('PutRequest', {}).get('Item', {}).get('id') != {'S': 'b'}]
+        response = batch_write_item(RequestItems={TABLE: requests})
+        if len(requests) < len(RequestItems[TABLE]):
+            response['UnprocessedItems'] = {TABLE: [request for request in RequestItems[TABLE] if request not in requests]}
+        return response
+
+    monkeypatch.setattr(index, 'BATCH_RETRIES', 0)
+    monkeypatch.setattr(client, 'batch_write_item', throttle_b)
+    response = index.handler({'Records': [
+        record('m1', 'create', {'Item': {'id': 'a'}}),
+        record('m2', 'create', {'Item': {'id': 'b'}}),
+        record('m3', 'bad', {}),
+        record('m4', 'create', {'Item': {'name': 'no key'}}),
+        record('m5', 'create', {'Item': {'id': 'c'}}),
+        record('m6', 'create', {'Item': {'id': 'b', 'value': 2}})
+    ]}, None)
+    assert sorted(failures(response)) == ['m2', 'm3', 'm4', 'm6']
+    assert table_ids(client) == ['a', 'c']
+
+
+def test_sqs_creates_are_written_in_batches(client, monkeypatch):
+    sizes = []
+    batch_write_item = client.batch_write_item
+
+    def recorded(RequestItems):
+        sizes.append(len(RequestItems[TABLE]))
+        return batch_write_item(RequestItems=RequestItems)
+
+    monkeypatch.setattr(client, 'batch_write_item', recorded)
+    response = index.handler({'Records': [
+        record('m{}'.format(number), 'create', {'Item': {'id': 'k{}'.format(number)}}) for number in range(10)
+    ] + [record('m10', 'delete', {'Key': {'id': 'k0'}})]}, None)
+    assert failures(response) == []
+    # one BatchWriteItem, the delete of k0 replaces its create
+    assert sizes == [10]
+    assert table_ids(client) == sorted('k{}'.format(number) for number in range(1, 10))
+
+
+def test_sqs_fifo_queue_stops_at_first_failure(client):
+    response = index.handler({'Records': [
+        record('m1', 'create', {'Item': {'id': 'a'}}, 'queue.fifo'),
+        record('m2', 'create', {'Item': {'id': 'b'}}, 'queue.fifo'),
+        record('m3', 'bad', {}, 'queue.fifo'),
+        record('m4', 'create', {'Item': {'id': 'c'}}, 'queue.fifo')
+    ]}, None)
+    assert failures(response) == ['m3', 'm4']
+    assert table_ids(client) == ['a', 'b']
+
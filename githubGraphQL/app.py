@@ -1,164 +1,1588 @@
 import os
+import abc
 import sys
 import json
-import csv
-import urllib3
-import socket
+import time
+import hashlib
 import logging
-import http
-import requests
-from requests.auth import HTTPProxyAuth
-from gql import Client, gql
-from gql.dsl import DSLSchema, DSLQuery, dsl_gql
-from gql.transport.requests import RequestsHTTPTransport
-from gql.transport.requests import log as requests_logger
-from datetime import datetime
-import re
-from urllib.parse import urlparse,unquote
+import threading
+import random
+from collections import deque
 
 #################################### variables on Environment #####################################################################
 # export USR='username' # proxy authentication
 # export PSW='password' # proxy authentication
 # export LOG_LEVEL='INFO'
 # export GITHUB_TOKEN='<>' # https://docs.github.com/en/graphql/guides/forming-calls-with-graphql#authenticating-with-graphql
+# export SCHEMA_CACHE_DIR='.schema_cache' # directory for the introspection schema cache
+# export SCHEMA_CACHE_TTL='86400' # seconds before the cached schema is fetched again
+# export SCHEMA_REFRESH='False' # use True to ignore the cached schema and refresh it
+# export GITHUB_TOKENS='<token1>,<token2>' # pool of tokens for the crawler, each one with its own rate limit
+# export GITHUB_OWNER='<login>' # user or organization to list the repositories, the viewer when not set
+# export GITHUB_OWNERS='<login1>,<login2>' # owners to crawl in parallel, OWNERS_FILE to read them one per line from a file
+# export WORKERS_PER_TOKEN='2' # crawler threads for every token
+# export PAGE_SIZE='100' # repositories per page (max 100)
+# export SYNC_DB='repos.db' # sqlite file for the incremental sync, only repositories updated since the last run are fetched
+# export QUERY_NODE_BUDGET='500000' # queries estimated over this node count are split before being sent
+# export RATE_LIMIT_RESERVE='100' # points of the hourly budget that are never spent
+# export RATE_LIMIT_POINTS_PER_MINUTE='2000' # secondary rate limit of points per minute
+# export RATE_LIMIT_MAX_IN_FLIGHT='10' # queries in flight per token
+# export JSON_CODEC='auto' # orjson, ujson or json to decode the responses, auto uses the first installed
+# export ACCEPT_ENCODING='gzip, br' # compressed responses, br only when brotli is installed
+# export GQL_TRANSPORT='requests' # use httpx to send the queries with HTTPX
+# export HTTP2='True' # HTTP/2 with httpx, needs pip install httpx[http2]
+# export HYDRATE_WORKERS='4' # concurrent nodes(ids) queries of hydrate
+# export HYDRATE_FIELDS='nameWithOwner,description' # repository fields of hydrate
+# export OUTPUT_FORMAT='text' # use ndjson or csv to stream the repositories, parquet or csv.gz to export them
+# export OUTPUT_FILE='repos.ndjson' # write the repositories to a file instead of stdout
+# export OUTPUT_DIR='export' # parquet or csv.gz files partitioned by owner and run date
+# export EXPORT_BATCH_SIZE='10000' # rows per exported file
+# export EXPORT_MAX_OPEN='8' # owners buffered in memory before the fullest batch is flushed
+# export PARQUET_COMPRESSION='zstd' # snappy, gzip or none
+# export STARTUP_BUDGET_MS='50' # import time budget of the startup benchmark
+#
+# python app.py [repos|sync|crawl|hydrate|query|cost|startup] --help
 ###################################################################################################################################
 
-# keep alive
-urllib3.connectionpool.HTTPConnection.default_socket_options = (
-    urllib3.connectionpool.HTTPConnection.default_socket_options + [
-        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
-        (socket.SOL_TCP, socket.TCP_KEEPIDLE, 45),
-        (socket.SOL_TCP, socket.TCP_KEEPINTVL, 10),
-        (socket.SOL_TCP, socket.TCP_KEEPCNT, 6)
-    ]
-)
-#logger
-logfmt = "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
-logdatefmt = "%m-%d-%Y %H:%M:%S"
-logging.basicConfig(
-    filename="app.log",
-    format=logfmt,
-    datefmt=logdatefmt,
-    filemode='a'
-)
-loglevel = os.environ.get('LOG_LEVEL','INFO')
+baseurl = 'https://api.github.com/graphql'
+retries=5
+
+# heavy modules (requests, urllib3, graphql, gql) are imported by the functions using them
+# so importing this module or running --help is cheap, nothing is configured until main runs
 logger = logging.getLogger()
+
+def config():
+    # keep alive
+    import socket
+    import urllib3
+    urllib3.connectionpool.HTTPConnection.default_socket_options = (
+        urllib3.connectionpool.HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            (socket.SOL_TCP, socket.TCP_KEEPIDLE, 45),
+            (socket.SOL_TCP, socket.TCP_KEEPINTVL, 10),
+            (socket.SOL_TCP, socket.TCP_KEEPCNT, 6)
+        ]
+    )
+
+def set_logger():
+    import http.client
+    from gql.transport.requests import log as requests_logger
+    logfmt = "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
+    logdatefmt = "%m-%d-%Y %H:%M:%S"
+    logging.basicConfig(
+        filename="app.log",
+        format=logfmt,
+        datefmt=logdatefmt,
+        filemode='a'
+    )
+    loglevel = os.environ.get('LOG_LEVEL','INFO')
+    logger = logging.getLogger()
+    # http logging
+    httplog = logging.getLogger('urllib3')
+    ch = logging.StreamHandler()
+    logger.setLevel(loglevel)
+    ch.setLevel(loglevel)
+    if loglevel == 'DEBUG':
+        requests_logger.setLevel(loglevel)
+        http.client.HTTPConnection.debuglevel = 1
+        http.client.print = print_to_log
+        httplog.addHandler(ch)
+        httplog.propagate = True
+    else:
+        requests_logger.setLevel('WARNING')
+        http.client.HTTPConnection.debuglevel = 0
+        httplog.addHandler(ch)
+        httplog.propagate = False
+    return logger
+
 # print log
 def print_to_log(*args):
     logger.debug(" ".join(args))
 
-# http logging
-httplog = logging.getLogger('urllib3')
-ch = logging.StreamHandler()
-logger.setLevel(loglevel)
-ch.setLevel(loglevel)
-if loglevel == 'DEBUG':
-    requests_logger.setLevel(loglevel)
-    http.client.HTTPConnection.debuglevel = 1
-    http.client.print = print_to_log
-    httplog.addHandler(ch)
-    httplog.propagate = True
-else:
-    requests_logger.setLevel('WARNING')
-    http.client.HTTPConnection.debuglevel = 0
-    httplog.addHandler(ch)
-    httplog.propagate = False
+# json codec
+class JSONCodec:
+    # dumps returns str and loads takes str or bytes, whatever the library behind it
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
 
-retries=5
+def orjson_codec():
+    import orjson
+    return JSONCodec('orjson', lambda obj: orjson.dumps(obj).decode('utf-8'), orjson.loads)
 
-user = os.environ.get('USR',None)
-password = os.environ.get('PSW',None)
+def ujson_codec():
+    import ujson
+    return JSONCodec('ujson', lambda obj: ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False), ujson.loads)
 
-# certificate
-cert = os.environ.get('CERTIFICATE',None)
-if cert == None:
-    certverify = True
-elif cert == False:
-    certverify = False
-    urllib3.disable_warnings()
-else:
-    certverify = cert
+def stdlib_codec():
+    return JSONCodec('json', lambda obj: json.dumps(obj, separators=(',',':'), ensure_ascii=False), json.loads)
 
-baseurl = 'https://api.github.com/graphql'
+json_codecs = {
+    'orjson': orjson_codec,
+    'ujson': ujson_codec,
+    'json': stdlib_codec
+}
+
+def get_json_codec(name=None):
+    # export JSON_CODEC='orjson', 'ujson' or 'json', with auto the first one installed is used
+    if name == None:
+        name = os.environ.get('JSON_CODEC','auto')
+    names = list(json_codecs) if name == 'auto' else [name]
+    for codec_name in names:
+        try:
+            codec = json_codecs[codec_name]()
+        except (ImportError, KeyError):
+            continue
+        logger.debug(f"Using {codec.name} json codec")
+        return codec
+    logger.warning(f"JSON codec {name} not available, using json")
+    return stdlib_codec()
+
+def accept_encoding():
+    # export ACCEPT_ENCODING to override, br is asked only when a brotli decoder is installed
+    import importlib.util
+    encoding = os.environ.get('ACCEPT_ENCODING',None)
+    if encoding != None:
+        return encoding
+    if importlib.util.find_spec('brotli') != None or importlib.util.find_spec('brotlicffi') != None:
+        return "gzip, br"
+    return "gzip, deflate"
+
+def get_codec_hook(codec):
+    # requests response hook decoding response.json() with codec, urllib3 already decompresses the body while reading it
+    # the queries sent are small so the requests keep the json encoder of requests
+    def decode_response(response, *args, **kwargs):
+        response.json = lambda **kwargs: codec.loads(response.content)
+        return response
+    return decode_response
+
+# result writers
+class ResultWriter:
+    # writes result nodes as they arrive instead of dumping the whole document at the end
+    def __init__(self, stream, codec=None, path=None):
+        self.stream = stream
+        self.codec = codec or get_json_codec()
+        self.path = path
+        self.count = 0
+
+    def write(self, node):
+        self.count += 1
+
+    def close(self):
+        self.stream.flush()
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+class NDJSONWriter(ResultWriter):
+    # one json document per line
+    def write(self, node):
+        self.stream.write(self.codec.dumps(node))
+        self.stream.write("\n")
+        self.count += 1
+
+class CSVWriter(ResultWriter):
+    # one row per node, nested objects are flattened as parent.child and lists are kept as json
+    # the header is taken from the first node, a node with columns missing from it starts a new part with all the columns
+
+    def __init__(self, stream, codec=None, path=None):
+        super().__init__(stream, codec, path)
+        self.writer = None
+        self.parts = 0
+
+    def write(self, node):
+        import csv
+        row = flatten_node(node)
+        if self.writer == None:
+            self.writer = csv.DictWriter(self.stream, fieldnames=list(row), restval='')
+            self.writer.writeheader()
+        extra = [column for column in row if column not in self.writer.fieldnames]
+        if extra:
+            self.next_part(self.writer.fieldnames + extra)
+        self.writer.writerow(row)
+        self.count += 1
+
+    def next_part(self, columns):
+        # a null object on the first node or nodes of another type give new columns, the rows already written keep their header
+        # on a file the next rows go to <file without extension>.<part><extension>, on stdout after a blank line
+        import csv
+        self.parts += 1
+        if self.path != None:
+            self.stream.close()
+            base, extension = os.path.splitext(self.path)
+            path = f"{base}.{self.parts}{extension}"
+            self.stream = open(path, 'w', encoding='utf-8', newline='')
+            logger.warning(f"CSV columns changed, writing the next rows to {path}")
+        else:
+            self.stream.write("\n")
+        self.writer = csv.DictWriter(self.stream, fieldnames=columns, restval='')
+        self.writer.writeheader()
+
+def flatten_node(node, prefix=''):
+    row = {}
+    for key, value in node.items():
+        if isinstance(value, dict):
+            row.update(flatten_node(value, f"{prefix}{key}."))
+        elif isinstance(value, list):
+            row[f"{prefix}{key}"] = json.dumps(value, separators=(',',':'), ensure_ascii=False)
+        else:
+            row[f"{prefix}{key}"] = value
+    return row
+
+# columnar export
+def node_owner(node):
+    # owner login of a repository node, from nameWithOwner or the path of its url
+    name = node.get('nameWithOwner')
+    if name == None and node.get('url') != None:
+        name = node['url'].split('://', 1)[-1].split('/', 1)[-1]
+    if name == None or '/' not in name:
+        return '_unknown'
+    return name.split('/')[0]
+
+class ColumnBatch:
+    # fixed-size batch stored by column, every column is a list of size values allocated once
+    # a row with columns the batch does not have needs a new batch (ColumnarWriter.write)
+    def __init__(self, columns, size):
+        self.columns = columns
+        self.size = size
+        self.values = [[None] * size for column in columns]
+        self.positions = {column: position for position, column in enumerate(columns)}
+        self.rows = 0
+
+    def missing(self, row):
+        return [column for column in row if column not in self.positions]
+
+    def append(self, row):
+        # returns True when the batch is full
+        extra = self.missing(row)
+        if extra:
+            raise ValueError(f"Row has columns missing from the batch {self.columns}: {extra}")
+        for column, value in row.items():
+            self.values[self.positions[column]][self.rows] = value
+        self.rows += 1
+        return self.rows >= self.size
+
+    def to_pydict(self):
+        return {column: values[:self.rows] for column, values in zip(self.columns, self.values)}
+
+class ColumnarWriter(ResultWriter, metaclass=abc.ABCMeta):
+    # repositories buffered on column batches per owner and flushed to files partitioned by owner and run date
+    # <path>/owner=<login>/run_date=<yyyy-mm-dd>/part-<run>-<n><extension>, the hive layout read by pyarrow, duckdb, spark and athena
+    # at most max_open batches of batch_size rows are kept in memory, the fullest one is flushed when a new owner needs room
+    # the batches take every column seen so far, a row with new columns (a null object on the first rows) flushes its batch
+    extension = ''
+
+    def __init__(self, path, batch_size=None, max_open=None, codec=None):
+        super().__init__(None, codec)
+        if batch_size == None:
+            batch_size = int(os.environ.get('EXPORT_BATCH_SIZE',10000))
+        if max_open == None:
+            max_open = int(os.environ.get('EXPORT_MAX_OPEN',8))
+        self.path = path
+        self.batch_size = batch_size
+        self.max_open = max_open
+        self.run_date = time.strftime('%Y-%m-%d', time.gmtime())
+        # files of other runs on the same day are kept
+        self.run_id = f"{time.strftime('%H%M%S', time.gmtime())}-{os.getpid()}"
+        self.batches = {}
+        self.parts = {}
+        self.files = []
+        self.columns = {}
+
+    def write(self, node):
+        owner = node_owner(node)
+        row = flatten_node(node)
+        for column in row:
+            self.columns.setdefault(column, None)
+        batch = self.batches.get(owner)
+        if batch != None and batch.missing(row):
+            self.flush(owner)
+            batch = None
+        if batch == None:
+            if len(self.batches) >= self.max_open:
+                self.flush(max(self.batches, key=lambda key: self.batches[key].rows))
+            batch = ColumnBatch(list(self.columns), self.batch_size)
+            self.batches[owner] = batch
+        if batch.append(row):
+            self.flush(owner)
+        self.count += 1
+
+    def flush(self, owner):
+        batch = self.batches.pop(owner)
+        if batch.rows == 0:
+            return
+        part = self.parts.get(owner, 0)
+        self.parts[owner] = part + 1
+        directory = os.path.join(self.path, f"owner={owner.replace(os.sep, '_')}", f"run_date={self.run_date}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{self.run_id}-{part:05d}{self.extension}")
+        self.write_batch(path, batch)
+        self.files.append(path)
+        logger.info(f"Exported {batch.rows} rows of {owner} to {path}")
+
+    @abc.abstractmethod
+    def write_batch(self, path, batch):
+        # writes the rows of batch to the file path
+        pass
 
-token = os.environ.get('GITHUB_TOKEN',None)
+    def close(self):
+        for owner in list(self.batches):
+            self.flush(owner)
 
-if token == None:
-    sys.exit("Github Token not found. Exiting...")
+class ParquetWriter(ColumnarWriter):
+    # one parquet file per batch, export PARQUET_COMPRESSION='snappy', 'gzip' or 'none' (zstd by default)
+    extension = '.parquet'
 
-headers = {
-    "Authorization": f"Bearer {token}"
+    def write_batch(self, path, batch):
+        import pyarrow
+        import pyarrow.parquet
+        compression = os.environ.get('PARQUET_COMPRESSION','zstd')
+        table = pyarrow.Table.from_pydict(batch.to_pydict())
+        pyarrow.parquet.write_table(table, path, compression=compression)
+
+class CSVGzipWriter(ColumnarWriter):
+    # one gzip csv file per batch with its own header, used when pyarrow is not installed
+    extension = '.csv.gz'
+
+    def write_batch(self, path, batch):
+        import csv
+        import gzip
+        columns = batch.to_pydict()
+        with gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=6) as f:
+            writer = csv.writer(f)
+            writer.writerow(list(columns))
+            writer.writerows(zip(*columns.values()))
+
+result_writers = {
+    'ndjson': NDJSONWriter,
+    'csv': CSVWriter
+}
+
+columnar_writers = {
+    'parquet': ParquetWriter,
+    'csv.gz': CSVGzipWriter
 }
 
-cookies = {}
-
-# set transport http
-transport = RequestsHTTPTransport(
-    url=baseurl,
-    headers=headers,
-    verify=certverify,
-    retries=retries,
-    cookies=cookies,
-    method='POST',
-    use_json=True
-)
-
-# set proxy different from environment
-prox = os.environ.get('SET_PROXY',None)
-if prox != None:
-    proxies = {
-        "http":f"{prox}",
-        "https":f"{prox}"
+def get_result_writer():
+    # export OUTPUT_FORMAT='ndjson' or 'csv' to stream the results, OUTPUT_FILE to write them to a file instead of stdout
+    # export OUTPUT_FORMAT='parquet' or 'csv.gz' to export them partitioned on OUTPUT_DIR
+    fmt = os.environ.get('OUTPUT_FORMAT','text')
+    if fmt in columnar_writers:
+        import importlib.util
+        if fmt == 'parquet' and importlib.util.find_spec('pyarrow') == None:
+            logger.warning("Parquet needs pyarrow (pip install pyarrow), exporting gzip csv")
+            fmt = 'csv.gz'
+        return columnar_writers[fmt](os.environ.get('OUTPUT_DIR','export'))
+    if fmt not in result_writers:
+        return None
+    path = os.environ.get('OUTPUT_FILE',None)
+    if path != None:
+        stream = open(path, 'w', encoding='utf-8', newline='')
+    else:
+        stream = sys.stdout
+    return result_writers[fmt](stream, path=path)
+
+def write_result(writer, result):
+    # every item of a list is written as its own node
+    for value in result.values():
+        if isinstance(value, list):
+            for node in value:
+                writer.write(node)
+        elif value != None:
+            writer.write(value)
+
+# schema cache
+def schema_cache_file(endpoint):
+    # one cache file per endpoint
+    cache_dir = os.environ.get('SCHEMA_CACHE_DIR','.schema_cache')
+    key = hashlib.sha256(endpoint.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{key}.graphql")
+
+def load_cached_schema(endpoint):
+    # return the cached schema while it is younger than SCHEMA_CACHE_TTL seconds
+    from graphql import build_schema
+    refresh = os.environ.get('SCHEMA_REFRESH','False')
+    if refresh == "True" or refresh == "true":
+        logger.info(f"Schema refresh requested for {endpoint}")
+        return None
+    ttl = int(os.environ.get('SCHEMA_CACHE_TTL',86400))
+    cachefile = schema_cache_file(endpoint)
+    try:
+        age = time.time() - os.path.getmtime(cachefile)
+        if age > ttl:
+            logger.info(f"Schema cache expired for {endpoint}")
+            return None
+        with open(cachefile, encoding='utf-8') as f:
+            schema = build_schema(f.read())
+    except FileNotFoundError:
+        logger.info(f"Schema cache not found for {endpoint}")
+        schema = None
+    except Exception as e:
+        logger.error(f"Error Loading cached schema : {e}")
+        schema = None
+    else:
+        logger.info(f"Using cached schema for {endpoint}")
+    return schema
+
+def save_cached_schema(endpoint,schema):
+    import tempfile
+    from graphql import print_schema
+    cachefile = schema_cache_file(endpoint)
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        # write to a temporary file and rename so readers never see a partial schema
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(cachefile))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(print_schema(schema))
+        os.replace(tmpfile, cachefile)
+    except Exception as e:
+        logger.error(f"Error Saving cached schema : {e}")
+    else:
+        logger.info(f"Schema cached for {endpoint} on {cachefile}")
+
+# rate limit
+class RateLimiter:
+    # paces the queries of every worker sharing a token
+    # the remaining points are spread evenly until resetAt, keeping RATE_LIMIT_RESERVE points unused
+    # secondary rate limits are avoided with a cap of points per minute and of queries in flight
+    # https://docs.github.com/en/graphql/overview/rate-limits-and-node-limits-for-the-graphql-api
+    def __init__(self, reserve=None, points_per_minute=None, max_in_flight=None):
+        self.reserve = int(reserve if reserve != None else os.environ.get('RATE_LIMIT_RESERVE',100))
+        self.points_per_minute = int(points_per_minute if points_per_minute != None else os.environ.get('RATE_LIMIT_POINTS_PER_MINUTE',2000))
+        self.max_in_flight = int(max_in_flight if max_in_flight != None else os.environ.get('RATE_LIMIT_MAX_IN_FLIGHT',10))
+        self.lock = threading.Lock()
+        self.in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        # budget of the current window, unknown until the first response
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        # cost of the last query is the estimate for the next one
+        self.cost = 1
+        # monotonic times
+        self.next_slot = 0
+        self.blocked_until = 0
+        self.spent = deque()
+        self.strikes = 0
+
+    def acquire(self):
+        # blocks until the next query can be sent
+        self.in_flight.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_slot, self.blocked_until)
+            start = max(start, self.minute_slot(start))
+            self.next_slot = start + self.interval()
+            self.spent.append((start, self.cost))
+            if self.remaining != None:
+                # other workers see the points already taken before the response arrives
+                self.remaining -= self.cost
+        wait = start - time.monotonic()
+        if wait > 0:
+            logger.debug(f"Rate limit waiting {round(wait, 3)}s")
+            time.sleep(wait)
+
+    def release(self):
+        self.in_flight.release()
+
+    def interval(self):
+        # seconds between queries to spend the budget evenly until the reset
+        if self.remaining == None or self.reset_at == None:
+            return 0
+        seconds = self.reset_at - time.time()
+        if seconds <= 0:
+            return 0
+        budget = self.remaining - self.reserve
+        if budget < self.cost:
+            return seconds
+        return seconds * self.cost / budget
+
+    def minute_slot(self, start):
+        # earliest time the next query fits on the points per minute
+        while self.spent and self.spent[0][0] <= start - 60:
+            self.spent.popleft()
+        used = sum(cost for _, cost in self.spent)
+        for sent, cost in self.spent:
+            if used + self.cost <= self.points_per_minute:
+                break
+            used -= cost
+            start = sent + 60
+        return start
+
+    def update(self, remaining=None, reset_at=None, cost=None, limit=None):
+        with self.lock:
+            if limit != None:
+                self.limit = limit
+            if cost != None and cost > 0:
+                self.cost = cost
+            if reset_at != None:
+                if self.reset_at != None and reset_at > self.reset_at + 1:
+                    # new window, drop the local estimate
+                    self.remaining = None
+                self.reset_at = reset_at
+            if remaining != None:
+                self.remaining = remaining if self.remaining == None else min(self.remaining, remaining)
+            if self.remaining != None and self.reset_at != None and self.remaining - self.reserve < self.cost:
+                wait = self.reset_at - time.time()
+                if wait > 0 and time.monotonic() + wait > self.blocked_until:
+                    logger.warning(f"Rate limit budget spent ({self.remaining} remaining), waiting {round(wait)}s for the reset")
+                    self.blocked_until = time.monotonic() + wait
+
+    def update_from_rate_limit(self, rate_limit):
+        # RateLimit { cost limit nodeCount remaining resetAt used } of a response
+        from datetime import datetime
+        reset_at = datetime.fromisoformat(rate_limit['resetAt'].replace('Z', '+00:00')).timestamp()
+        self.update(rate_limit['remaining'], reset_at, rate_limit['cost'], rate_limit['limit'])
+
+    def update_from_headers(self, headers):
+        # x-ratelimit-* headers come on every response, including the errors
+        try:
+            remaining = int(headers['x-ratelimit-remaining'])
+            reset_at = int(headers['x-ratelimit-reset'])
+            limit = int(headers['x-ratelimit-limit'])
+        except (KeyError, ValueError):
+            return
+        self.update(remaining, reset_at, None, limit)
+
+    def backoff(self, seconds=None):
+        # secondary rate limit hit, wait retry-after or at least one minute growing on every strike
+        with self.lock:
+            self.strikes += 1
+            if seconds == None:
+                seconds = min(60 * 2 ** (self.strikes - 1), 900) + random.uniform(0, 5)
+            logger.warning(f"Secondary rate limit hit, waiting {round(seconds)}s")
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def succeeded(self):
+        self.strikes = 0
+
+    def status(self):
+        return {
+            "limit": self.limit,
+            "remaining": self.remaining,
+            "resetAt": self.reset_at,
+            "cost": self.cost,
+            "interval": round(self.interval(), 3)
+        }
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(token):
+    # one budget per token shared by all the workers using it
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    with rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter()
+        return rate_limiters[key]
+
+def rate_limited_response(response):
+    # 429, retry-after, no points remaining or a secondary rate limit message
+    # other 403 (permissions, sso) are errors, they are raised without waiting
+    if response.status_code == 429:
+        return True
+    if response.headers.get('retry-after') != None or response.headers.get('x-ratelimit-remaining') == '0':
+        return True
+    if hasattr(response, 'read'):
+        # httpx event hooks run before the body is read
+        response.read()
+    message = response.text.lower()
+    return 'secondary rate limit' in message or 'abuse detection' in message
+
+def get_rate_limit_hook(limiter):
+    # requests response hook, keeps the limiter updated from the headers and backs off on rate limited 403/429
+    def hook(response, *args, **kwargs):
+        limiter.update_from_headers(response.headers)
+        if response.status_code in (403, 429):
+            if rate_limited_response(response):
+                retry_after = response.headers.get('retry-after')
+                if retry_after != None and retry_after.isdigit():
+                    limiter.backoff(int(retry_after))
+                elif response.headers.get('x-ratelimit-remaining') != '0':
+                    limiter.backoff()
+        elif response.status_code < 400:
+            limiter.succeeded()
+        return response
+    return hook
+
+def rate_limited_error(e):
+    # rate limits can also come as graphql errors with http 200
+    from gql.transport.exceptions import TransportServerError
+    if isinstance(e, TransportServerError):
+        if e.code not in (403, 429):
+            return False
+        # the transports raise it from the http error of the response
+        response = getattr(e.__cause__, 'response', None)
+        if response is None:
+            return e.code == 429
+        return rate_limited_response(response)
+    for error in e.errors or []:
+        if isinstance(error, dict) and error.get('type') == 'RATE_LIMITED':
+            return True
+    return False
+
+class RateLimitedSession:
+    # gql session sending every query through the rate limiter of its token
+    def __init__(self, session, limiter, retries=5):
+        self.session = session
+        self.transport = session.transport
+        self.limiter = limiter
+        self.retries = retries
+
+    def execute(self, query, **kwargs):
+        from gql.transport.exceptions import TransportServerError, TransportQueryError
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                result = self.session.execute(query, **kwargs)
+            except (TransportServerError, TransportQueryError) as e:
+                if not rate_limited_error(e) or attempt >= self.retries:
+                    raise
+                attempt += 1
+                if isinstance(e, TransportQueryError):
+                    self.limiter.backoff()
+                logger.warning(f"Rate limited, retry {attempt} of {self.retries}")
+                continue
+            finally:
+                self.limiter.release()
+            if isinstance(result.get('RateLimit'), dict):
+                self.limiter.update_from_rate_limit(result['RateLimit'])
+            return result
+
+# query cost
+def query_node_budget():
+    return int(os.environ.get('QUERY_NODE_BUDGET',500000))
+
+def query_cost(document, variables=None, operation_name=None):
+    # static estimate of nodeCount and cost as github computes them, before the query is sent
+    # every connection (field with first or last) asks for that many nodes for each node of its parent connections
+    # cost is the number of requests to fill every connection divided by 100, at least 1
+    # https://docs.github.com/en/graphql/overview/rate-limits-and-node-limits-for-the-graphql-api
+    from graphql import value_from_ast_untyped
+    from graphql.pyutils import Undefined
+    fragments = query_fragments(document)
+    totals = {"nodeCount": 0, "requests": 0}
+
+    def walk(selection_set, parents, values):
+        for selection in selection_set.selections:
+            if selection.kind == 'field':
+                size = None
+                for argument in selection.arguments or []:
+                    if argument.name.value in ('first', 'last'):
+                        size = value_from_ast_untyped(argument.value, values)
+                        if size is Undefined:
+                            # a variable without default and not given, github would reject the query
+                            raise ValueError(f"Variable ${argument.value.name.value} of {selection.name.value}({argument.name.value}) has no value, pass it with --variables")
+                if size != None:
+                    totals["requests"] += parents
+                    totals["nodeCount"] += parents * size
+                    children = parents * size
+                else:
+                    children = parents
+                if selection.selection_set != None:
+                    walk(selection.selection_set, children, values)
+            elif selection.kind == 'inline_fragment':
+                walk(selection.selection_set, parents, values)
+            elif selection.kind == 'fragment_spread':
+                walk(fragments[selection.name.value].selection_set, parents, values)
+
+    for definition in document.definitions:
+        if definition.kind != 'operation_definition':
+            continue
+        if operation_name != None and (definition.name == None or definition.name.value != operation_name):
+            continue
+        # variables not given take the default of their definition
+        values = {}
+        for variable in definition.variable_definitions or []:
+            if variable.default_value != None:
+                values[variable.variable.name.value] = value_from_ast_untyped(variable.default_value)
+        values.update(variables or {})
+        walk(definition.selection_set, 1, values)
+    return {
+        "nodeCount": totals["nodeCount"],
+        "cost": max(1, round(totals["requests"] / 100))
+    }
+
+def query_fragments(document):
+    return {
+        definition.name.value: definition
+        for definition in document.definitions
+        if definition.kind == 'fragment_definition'
     }
-    transport.proxies = proxies
-
-# Add Proxy authentication
-if user != None and password != None:
-    proxyauth=HTTPProxyAuth(username=user,password=password)
-    transport.auth = proxyauth
-
-#https://gql.readthedocs.io/en/latest/usage/variables.html
-params = {}
-
-client = Client(transport=transport, fetch_schema_from_transport=True)
-
-# github query doc - https://docs.github.com/en/graphql/reference/queries
-
-result = {}
-with client as session:
-    assert client.schema is not None
-    # Instantiate the root of the DSL Schema as ds
-    ds = DSLSchema(client.schema)
-    # Create the query using dynamically generated attributes from ds
-    query = dsl_gql(
-        DSLQuery(
-            Login=ds.Query.viewer.select(
-                ds.User.login
-            ),
-            Repository=ds.Query.viewer.select(
-                ds.User.repositories(
-                    first=100
-                ).select(
-                    ds.RepositoryConnection.nodes.select(
-                        ds.Repository.name,
-                        ds.Repository.url,
-                        ds.Repository.visibility
-                    )
+
+def used_names(node, variables, fragments):
+    # variables and fragment spreads used under an ast node
+    if node.kind == 'variable':
+        variables.add(node.name.value)
+        return
+    if node.kind == 'fragment_spread':
+        fragments.add(node.name.value)
+    for key in node.keys:
+        if key == 'loc':
+            continue
+        value = getattr(node, key)
+        for child in value if isinstance(value, (list, tuple)) else [value]:
+            if hasattr(child, 'kind'):
+                used_names(child, variables, fragments)
+
+def query_part(document, operation, selections, variables):
+    # document with some of the root fields of operation and only the variables and fragments they use
+    from graphql import DocumentNode, OperationDefinitionNode, SelectionSetNode
+    fragments = query_fragments(document)
+    used_variables = set()
+    used_fragments = set()
+    for selection in selections:
+        used_names(selection, used_variables, used_fragments)
+    # follow the fragments used by other fragments
+    visited = set()
+    while used_fragments - visited:
+        name = (used_fragments - visited).pop()
+        visited.add(name)
+        used_names(fragments[name], used_variables, used_fragments)
+    part = OperationDefinitionNode(
+        operation=operation.operation,
+        name=operation.name,
+        directives=operation.directives,
+        variable_definitions=tuple(
+            variable for variable in operation.variable_definitions or []
+            if variable.variable.name.value in used_variables
+        ),
+        selection_set=SelectionSetNode(selections=tuple(selections))
+    )
+    definitions = [part] + [fragments[name] for name in fragments if name in used_fragments]
+    part_variables = {name: value for name, value in (variables or {}).items() if name in used_variables}
+    return DocumentNode(definitions=tuple(definitions)), part_variables
+
+def connection_paths(selection_set, path=()):
+    # connections (fields with first or last) reached from a root field without crossing another connection
+    # yields the response keys from the root field down to the connection and the connection field
+    for selection in selection_set.selections:
+        if selection.kind == 'inline_fragment':
+            yield from connection_paths(selection.selection_set, path)
+        elif selection.kind == 'field':
+            key = (selection.alias or selection.name).value
+            if any(argument.name.value in ('first', 'last') for argument in selection.arguments or []):
+                yield path + (key,), selection
+            elif selection.selection_set != None:
+                yield from connection_paths(selection.selection_set, path + (key,))
+
+def paged_query_part(document, operation, selection, variables, path, budget):
+    # document with the root field selection and the connection on path read in pages within the budget
+    # the page size and the cursor are the variables $splitSize and $splitCursor
+    # returns (document, variables, pages) or None when one node per page is still over the budget
+    import copy
+    from graphql import parse, SelectionSetNode, VariableNode, NameNode, ArgumentNode, value_from_ast_untyped
+    selection = copy.deepcopy(selection)
+    connection = dict(connection_paths(SelectionSetNode(selections=(selection,))))[path]
+    arguments = {argument.name.value: argument for argument in connection.arguments}
+    backward = 'first' not in arguments
+    size_name, cursor_name = ('last', 'before') if backward else ('first', 'after')
+    size = value_from_ast_untyped(arguments[size_name].value, variables)
+    cursor = value_from_ast_untyped(arguments[cursor_name].value, variables) if cursor_name in arguments else None
+    arguments[size_name] = ArgumentNode(name=NameNode(value=size_name), value=VariableNode(name=NameNode(value='splitSize')))
+    arguments[cursor_name] = ArgumentNode(name=NameNode(value=cursor_name), value=VariableNode(name=NameNode(value='splitCursor')))
+    connection.arguments = tuple(arguments.values())
+    page_info = "startCursor hasPreviousPage" if backward else "endCursor hasNextPage"
+    connection.selection_set = SelectionSetNode(
+        selections=tuple(connection.selection_set.selections) + parse(f"{{ splitPageInfo: pageInfo {{ {page_info} }} }}").definitions[0].selection_set.selections
+    )
+    part, part_variables = query_part(document, operation, [selection], variables)
+    part.definitions[0].variable_definitions = tuple(part.definitions[0].variable_definitions) + parse(
+        "query ($splitSize: Int!, $splitCursor: String) { root }"
+    ).definitions[0].variable_definitions
+    part_variables = dict(part_variables, splitSize=size, splitCursor=cursor)
+    if query_cost(part, dict(part_variables, splitSize=1))["nodeCount"] > budget:
+        return None
+    part_variables["splitSize"] = fit_page_size(part, part_variables, 'splitSize', budget)
+    pages = {"path": path, "size": part_variables["splitSize"], "backward": backward}
+    return part, part_variables, pages
+
+def split_query(document, variables=None, budget=None):
+    # groups the root fields of a query over budget on smaller queries, each one within the budget
+    # a root field over the budget alone is read in pages: the first or last of its largest connection is lowered
+    # and the connection is followed with its cursor by execute_within_budget
+    # returns a list of (document, variables, pages), pages is None for the queries sent once
+    from graphql import SelectionSetNode
+    if budget == None:
+        budget = query_node_budget()
+    estimate = query_cost(document, variables)
+    logger.debug(f"Query estimate {estimate}")
+    if estimate["nodeCount"] <= budget:
+        return [(document, variables, None)]
+    operations = [definition for definition in document.definitions if definition.kind == 'operation_definition']
+    if len(operations) != 1:
+        raise ValueError("Only queries with one operation can be split")
+    operation = operations[0]
+    if operation.variable_definitions and any(variable.variable.name.value in ('splitSize', 'splitCursor') for variable in operation.variable_definitions):
+        raise ValueError("Variables $splitSize and $splitCursor are used to split the queries")
+    parts = []
+    selections = []
+    nodes = 0
+    for selection in operation.selection_set.selections:
+        part, part_variables = query_part(document, operation, [selection], variables)
+        size = query_cost(part, part_variables)["nodeCount"]
+        if size > budget:
+            # the connection with the most nodes is paged first
+            connections = []
+            for path, connection in connection_paths(SelectionSetNode(selections=(selection,))):
+                connection_part, connection_variables = query_part(document, operation, [connection], variables)
+                connections.append((query_cost(connection_part, connection_variables)["nodeCount"], path))
+            paged = None
+            for _, path in sorted(connections, reverse=True):
+                paged = paged_query_part(document, operation, selection, variables, path, budget)
+                if paged != None:
+                    break
+            if paged == None:
+                name = selection.alias.value if getattr(selection, 'alias', None) else getattr(selection, 'name', None)
+                name = getattr(name, 'value', name)
+                raise ValueError(f"Field {name} needs {size} nodes, over the budget of {budget} even with pages of one node")
+            parts.append(paged)
+            continue
+        if selections and nodes + size > budget:
+            parts.append(query_part(document, operation, selections, variables) + (None,))
+            selections = []
+            nodes = 0
+        selections.append(selection)
+        nodes += size
+    if selections:
+        parts.append(query_part(document, operation, selections, variables) + (None,))
+    logger.info(f"Query of {estimate['nodeCount']} nodes split in {len(parts)} queries")
+    return parts
+
+def execute_pages(session, document, variables, pages):
+    # execute a paged query until its last page, the nodes and edges of every page are added to the first one
+    result = None
+    while True:
+        page = session.execute(document, variable_values=variables)
+        connection = page
+        for key in pages["path"]:
+            if isinstance(connection, list):
+                raise ValueError(f"Connection {'.'.join(pages['path'])} is inside a list, it can not be read in pages")
+            connection = connection.get(key) if connection != None else None
+        if connection == None:
+            # null on the path, nothing else to read
+            return page if result == None else result
+        page_info = connection.pop('splitPageInfo')
+        if result == None:
+            result = page
+            merged = connection
+        else:
+            for key in ('nodes', 'edges'):
+                if isinstance(connection.get(key), list):
+                    if pages["backward"]:
+                        merged[key][:0] = connection[key]
+                    else:
+                        merged[key].extend(connection[key])
+        if pages["backward"]:
+            more, cursor = page_info['hasPreviousPage'], page_info['startCursor']
+        else:
+            more, cursor = page_info['hasNextPage'], page_info['endCursor']
+        if not more or cursor == None:
+            return result
+        variables = dict(variables, splitCursor=cursor)
+
+def execute_within_budget(session, document, variables=None, budget=None):
+    # execute a query split when needed, the results of the parts are merged by their root fields
+    result = {}
+    for part, part_variables, pages in split_query(document, variables, budget):
+        if pages == None:
+            result.update(session.execute(part, variable_values=part_variables))
+        else:
+            result.update(execute_pages(session, part, part_variables, pages))
+    return result
+
+def fit_page_size(document, variables, name='first', budget=None):
+    # largest page size up to variables[name] keeping the query within the budget
+    if budget == None:
+        budget = query_node_budget()
+    low = 1
+    high = variables[name]
+    while low < high:
+        middle = (low + high + 1) // 2
+        if query_cost(document, dict(variables, **{name: middle}))["nodeCount"] <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    if low != variables[name]:
+        logger.info(f"Page size reduced from {variables[name]} to {low} to stay within {budget} nodes")
+    return low
+
+# repositories
+def repository_fields(ds):
+    # fields kept for each repository
+    return (
+        ds.Repository.id,
+        ds.Repository.name,
+        ds.Repository.url,
+        ds.Repository.visibility,
+        ds.Repository.updatedAt
+    )
+
+def rate_limit_fields(ds):
+    return (
+        ds.RateLimit.cost,
+        ds.RateLimit.limit,
+        ds.RateLimit.nodeCount,
+        ds.RateLimit.remaining,
+        ds.RateLimit.resetAt,
+        ds.RateLimit.used
+    )
+
+def repositories_page_query(ds,owner):
+    # one page of repositories of the viewer or of an owner (user or organization)
+    # variables: {"first": 100, "after": <endCursor of the previous page>, "login": <owner>, "orderBy": {"field": "UPDATED_AT", "direction": "DESC"}}
+    from gql.dsl import DSLQuery, DSLVariableDefinitions, dsl_gql
+    var = DSLVariableDefinitions()
+    if owner:
+        root = ds.Query.repositoryOwner.args(login=var.login)
+        repositories = ds.RepositoryOwner.repositories
+    else:
+        root = ds.Query.viewer
+        repositories = ds.User.repositories
+    page = DSLQuery(
+        Owner=root.select(
+            repositories.args(
+                first=var.first,
+                after=var.after,
+                orderBy=var.orderBy
+            ).select(
+                ds.RepositoryConnection.pageInfo.select(
+                    ds.PageInfo.endCursor,
+                    ds.PageInfo.hasNextPage
+                ),
+                ds.RepositoryConnection.nodes.select(
+                    *repository_fields(ds)
                 )
-            ),
-            RateLimit=ds.Query.rateLimit.select(
-                ds.RateLimit.cost,
-                ds.RateLimit.limit,
-                ds.RateLimit.nodeCount,
-                ds.RateLimit.remaining,
-                ds.RateLimit.resetAt,
-                ds.RateLimit.used
             )
+        ),
+        RateLimit=ds.Query.rateLimit.select(
+            *rate_limit_fields(ds)
         )
     )
+    page.variable_definitions = var
+    return dsl_gql(GetRepositories=page)
+
+class OwnerNotFound(LookupError):
+    # repositoryOwner is null, the login does not exist or the token can not see it
+    pass
+
+def iter_repositories(session,ds,owner=None,page_size=100,status=None,since=None):
+    # yields the repository nodes following pageInfo { endCursor hasNextPage }
+    # the next page is requested on a background thread while the caller processes the current one
+    # so at most two pages are kept in memory, the last RateLimit seen is saved on status
+    # with since the repositories come ordered by UPDATED_AT DESC and paging stops on the first one older than since
+    from concurrent.futures import ThreadPoolExecutor
+    query = repositories_page_query(ds,owner)
+    variables = {"first": page_size, "after": None}
+    if owner:
+        variables["login"] = owner
+    if since != None:
+        variables["orderBy"] = {"field": "UPDATED_AT", "direction": "DESC"}
+    variables["first"] = fit_page_size(query, variables)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(session.execute, query, variable_values=dict(variables))
+        page = 0
+        while future != None:
+            result = future.result()
+            page += 1
+            if result['Owner'] == None:
+                raise OwnerNotFound(f"Repository owner {owner} not found")
+            connection = result['Owner']['repositories']
+            if status != None:
+                status['RateLimit'] = result['RateLimit']
+            nodes = [node for node in connection['nodes'] if node != None]
+            page_info = connection['pageInfo']
+            unchanged = since != None and nodes and nodes[-1]['updatedAt'] < since
+            if page_info['hasNextPage'] and not unchanged:
+                variables["after"] = page_info['endCursor']
+                future = executor.submit(session.execute, query, variable_values=dict(variables))
+            else:
+                future = None
+            logger.info(f"Repositories page {page} with {len(nodes)} nodes")
+            for node in nodes:
+                if since != None and node['updatedAt'] < since:
+                    logger.info(f"Repositories unchanged since {since}, stopped on page {page}")
+                    return
+                yield node
+
+# hydration
+def nodes_query(ds,type_name,fields):
+    # nodes(ids: $ids) selecting fields on type_name, fields are names of type_name or dsl fields
+    from gql.dsl import DSLQuery, DSLVariableDefinitions, DSLInlineFragment, dsl_gql
+    dsl_type = getattr(ds, type_name)
+    selection = [getattr(dsl_type, field) if isinstance(field, str) else field for field in fields]
+    var = DSLVariableDefinitions()
+    nodes = DSLQuery(
+        Nodes=ds.Query.nodes.args(ids=var.ids).select(
+            ds.Node.id,
+            DSLInlineFragment().on(dsl_type).select(*selection)
+        )
+    )
+    nodes.variable_definitions = var
+    return dsl_gql(GetNodes=nodes)
+
+def hydrate_nodes(session,ds,ids,fields,type_name='Repository',chunk_size=100,workers=None):
+    # more fields for a list of global node ids, in chunks of up to 100 ids (the github limit of nodes) sent concurrently
+    # returns the nodes on the order of ids, None when the id was not found and "Failed" when its chunk failed
+    from concurrent.futures import ThreadPoolExecutor
+    from gql.transport.exceptions import TransportQueryError
+    if workers == None:
+        workers = int(os.environ.get('HYDRATE_WORKERS',4))
+    query = nodes_query(ds, type_name, fields)
+    unique = list(dict.fromkeys(ids))
+    chunks = [unique[index:index + chunk_size] for index in range(0, len(unique), chunk_size)]
+    logger.info(f"Hydrating {len(unique)} nodes in {len(chunks)} queries")
+
+    def fetch(chunk):
+        try:
+            result = session.execute(query, variable_values={"ids": chunk})
+        except TransportQueryError as e:
+            # ids that can not be resolved come as errors with the other nodes on data
+            if e.data == None:
+                raise
+            logger.warning(f"Error Hydrating nodes : {e.errors[0] if e.errors else e}")
+            result = e.data
+        return result['Nodes']
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+        futures = [(chunk, executor.submit(fetch, chunk)) for chunk in chunks]
+        for chunk, future in futures:
+            try:
+                nodes = future.result()
+            except Exception as e:
+                logger.error(f"Error Hydrating {len(chunk)} nodes : {e}")
+                nodes = ["Failed"] * len(chunk)
+            for node_id, node in zip(chunk, nodes):
+                found[node_id] = node
+    return [found.get(node_id) for node_id in ids]
+
+# incremental sync
+class RepositoryStore:
+    # sqlite store of the repository nodes with the newest updatedAt synced per owner (high-water mark)
+    def __init__(self, path):
+        import sqlite3
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.codec = get_json_codec()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS repositories (id TEXT PRIMARY KEY, owner TEXT, name TEXT, url TEXT, visibility TEXT, updated_at TEXT, data TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS repositories_owner ON repositories (owner)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, updated_at TEXT, synced_at TEXT)"
+        )
+
+    def high_water_mark(self, owner):
+        with self.lock:
+            row = self.db.execute("SELECT updated_at FROM owners WHERE owner = ?", (owner,)).fetchone()
+        return row[0] if row else None
+
+    def upsert(self, owner, nodes, updated_at=None):
+        # one transaction per batch, the high-water mark is moved only with the last batch of a sync
+        rows = [
+            (node['id'], owner, node['name'], node['url'], node['visibility'], node['updatedAt'],
+             self.codec.dumps(node))
+            for node in nodes
+        ]
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT INTO repositories (id, owner, name, url, visibility, updated_at, data) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET owner = excluded.owner, name = excluded.name, url = excluded.url, "
+                "visibility = excluded.visibility, updated_at = excluded.updated_at, data = excluded.data",
+                rows
+            )
+            if updated_at != None:
+                self.db.execute(
+                    "INSERT INTO owners (owner, updated_at, synced_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(owner) DO UPDATE SET updated_at = excluded.updated_at, synced_at = excluded.synced_at",
+                    (owner, updated_at, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+                )
+
+    def count(self, owner):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM repositories WHERE owner = ?", (owner,)).fetchone()[0]
+
+    def close(self):
+        self.db.close()
 
-    result = session.execute(query)
-    logger.debug(f"Success : {json.dumps(result)}")
-for repo in result['Repository']['repositories']['nodes']:
+def sync_repositories(session,ds,store,owner_key,owner=None,page_size=100,status=None,writer=None):
+    # fetch only the repositories updated since the high-water mark of the owner and upsert them per page
+    since = store.high_water_mark(owner_key)
+    logger.info(f"Sync of {owner_key} since {since}")
+    newest = since
+    batch = []
+    synced = 0
+    for repo in iter_repositories(session, ds, owner, page_size, status, since):
+        if newest == None or repo['updatedAt'] > newest:
+            newest = repo['updatedAt']
+        batch.append(repo)
+        if writer != None:
+            writer.write(repo)
+        if len(batch) >= page_size:
+            store.upsert(owner_key, batch)
+            synced += len(batch)
+            batch = []
+    store.upsert(owner_key, batch, newest)
+    synced += len(batch)
+    return synced
+
+def print_repository(repo):
     print(f"Repository\n Name: {repo['name']}\n URL: {repo['url']}\n Visibility: {repo['visibility']}\n")
-print(f"Rate Limits:\n Cost: {result['RateLimit']['cost']}\n Limit: {result['RateLimit']['limit']}\n Used: {result['RateLimit']['used']}\n Remaining: {result['RateLimit']['remaining']}\n ResetAt: {result['RateLimit']['resetAt']}\n")
\ No newline at end of file
+
+class SharedWriter:
+    # output shared by the crawler threads, every node is written whole
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+
+    def write(self, node):
+        with self.lock:
+            if self.writer == None:
+                print_repository(node)
+            else:
+                self.writer.write(node)
+
+class RetryTransport:
+    # wraps an httpx transport retrying the status codes retried by the requests transport
+    # 403 and the graphql rate limit errors are left to RateLimitedSession
+    def __init__(self, transport, retries, backoff_factor=0.1, status_forcelist=(429, 500, 502, 503, 504)):
+        self.transport = transport
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+
+    def handle_request(self, request):
+        attempt = 0
+        while True:
+            response = self.transport.handle_request(request)
+            if response.status_code not in self.status_forcelist or attempt >= self.retries:
+                return response
+            retry_after = response.headers.get('retry-after')
+            response.read()
+            response.close()
+            if retry_after != None and retry_after.isdigit():
+                wait = int(retry_after)
+            else:
+                wait = min(self.backoff_factor * 2 ** attempt, 120)
+            attempt += 1
+            logger.warning(f"Retrying {request.url} after status {response.status_code}, retry {attempt} of {self.retries} in {wait}s")
+            time.sleep(wait)
+
+    def close(self):
+        self.transport.close()
+
+    def __enter__(self):
+        self.transport.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.transport.__exit__(*args)
+
+def httpx_transport_args(endpoint,certverify):
+    # connection settings of the httpx transport
+    # the client does not read the proxy from the environment, it is resolved here so USR/PSW also apply to it
+    import ssl
+    import httpx
+    import importlib.util
+    from urllib.parse import urlparse
+    from urllib.request import getproxies, proxy_bypass
+    http2 = os.environ.get('HTTP2','True')
+    http2 = http2 == "True" or http2 == "true"
+    if http2 and importlib.util.find_spec('h2') == None:
+        logger.warning("HTTP/2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+        http2 = False
+    if isinstance(certverify, str):
+        certverify = ssl.create_default_context(cafile=certverify)
+    transport_args = {
+        "verify": certverify,
+        "http2": http2,
+        # connection errors, the status codes are retried by RetryTransport
+        "retries": retries
+    }
+    url = urlparse(endpoint)
+    prox = os.environ.get('SET_PROXY',None)
+    if prox == None and not proxy_bypass(url.hostname):
+        prox = getproxies().get(url.scheme)
+    if prox != None:
+        # Add Proxy authentication
+        user = os.environ.get('USR',None)
+        password = os.environ.get('PSW',None)
+        auth = (user, password) if user != None and password != None else None
+        transport_args["proxy"] = httpx.Proxy(prox, auth=auth)
+    return transport_args
+
+def get_httpx_transport(endpoint,headers,certverify,limiter):
+    # HTTPX transport, with HTTP/2 the workers of a token share one multiplexed connection
+    # the requests hooks take the response as first argument so they are also httpx event hooks
+    import httpx
+    from gql.transport.httpx import HTTPXTransport
+    codec = get_json_codec()
+    return HTTPXTransport(
+        url=endpoint,
+        headers=headers,
+        timeout=120,
+        transport=RetryTransport(httpx.HTTPTransport(**httpx_transport_args(endpoint, certverify)), retries),
+        event_hooks={"response": [get_codec_hook(codec), get_rate_limit_hook(limiter)]},
+        trust_env=False
+    )
+
+def get_gql_transport(endpoint,token):
+    import urllib3
+    from requests.auth import HTTPProxyAuth
+    from gql.transport.requests import RequestsHTTPTransport
+    # certificate
+    cert = os.environ.get('CERTIFICATE',None)
+    if cert == None:
+        certverify = True
+    elif cert == "False" or cert == "false":
+        certverify = False
+        urllib3.disable_warnings()
+    else:
+        certverify = cert
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Accept-Encoding": accept_encoding()
+    }
+    cookies = {}
+    # shared budget of the token
+    limiter = get_rate_limiter(token)
+    if os.environ.get('GQL_TRANSPORT','requests') == 'httpx':
+        return get_httpx_transport(endpoint, headers, certverify, limiter)
+    # set transport http
+    transport = RequestsHTTPTransport(
+        url=endpoint,
+        headers=headers,
+        verify=certverify,
+        retries=retries,
+        cookies=cookies,
+        method='POST',
+        use_json=True,
+        hooks={"response": [get_codec_hook(get_json_codec()), get_rate_limit_hook(limiter)]}
+    )
+    # set proxy different from environment
+    prox = os.environ.get('SET_PROXY',None)
+    if prox != None:
+        proxies = {
+            "http":f"{prox}",
+            "https":f"{prox}"
+        }
+        transport.proxies = proxies
+    # Add Proxy authentication
+    user = os.environ.get('USR',None)
+    password = os.environ.get('PSW',None)
+    if user != None and password != None:
+        proxyauth=HTTPProxyAuth(username=user,password=password)
+        transport.auth = proxyauth
+    return transport
+
+def get_owners(owners=None,path=None):
+    # GITHUB_OWNERS comma separated or OWNERS_FILE with one owner per line
+    if owners == None:
+        owners = os.environ.get('GITHUB_OWNERS','')
+    if path == None:
+        path = os.environ.get('OWNERS_FILE',None)
+    owners = [owner.strip() for owner in owners.split(',') if owner.strip()]
+    if path != None:
+        with open(path, encoding='utf-8') as f:
+            owners += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return list(dict.fromkeys(owners))
+
+def crawl_owners(endpoint,tokens,schema,owners,page_size=100,writer=None,store=None,workers_per_token=None):
+    # repositories of many owners with a pool of tokens
+    # every token gets workers_per_token threads sharing the client and the rate limiter of the token
+    # with httpx and HTTP/2 the queries of those threads are multiplexed over one connection
+    # the owners are taken from one queue so a slow owner does not hold the others, the nodes go to one shared writer
+    import queue
+    from gql import Client
+    from gql.dsl import DSLSchema
+    if workers_per_token == None:
+        workers_per_token = int(os.environ.get('WORKERS_PER_TOKEN',2))
+    pending = queue.Queue()
+    for owner in owners:
+        pending.put(owner)
+    output = SharedWriter(writer)
+    summary = {}
+
+    def worker(client, limiter):
+        session = RateLimitedSession(client.session, limiter, retries)
+        ds = DSLSchema(client.schema)
+        while True:
+            try:
+                owner = pending.get_nowait()
+            except queue.Empty:
+                return
+            status = {}
+            try:
+                if store != None:
+                    count = sync_repositories(session, ds, store, owner, owner, page_size, status, output)
+                else:
+                    count = 0
+                    for repo in iter_repositories(session, ds, owner, page_size, status):
+                        output.write(repo)
+                        count += 1
+            except Exception as e:
+                logger.error(f"Error Crawling {owner} : {e}")
+                summary[owner] = "Failed"
+            else:
+                logger.info(f"Crawled {count} repositories of {owner}")
+                summary[owner] = count
+
+    clients = []
+    try:
+        threads = []
+        for index, token in enumerate(tokens):
+            client = Client(transport=get_gql_transport(endpoint,token), schema=schema)
+            client.connect_sync()
+            clients.append(client)
+            limiter = get_rate_limiter(token)
+            for worker_index in range(workers_per_token):
+                threads.append(threading.Thread(target=worker, args=(client, limiter), name=f"crawler-{index}-{worker_index}"))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for client in clients:
+            client.close_sync()
+    return summary
+
+def get_tokens():
+    # GITHUB_TOKENS comma separated or GITHUB_TOKEN
+    token = os.environ.get('GITHUB_TOKEN',None)
+    return [t.strip() for t in os.environ.get('GITHUB_TOKENS',token or '').split(',') if t.strip()]
+
+def run(command,owner=None,owners=None,page_size=100,sync_db=None,ids=None,fields=None,document=None,variables=None):
+    from gql import Client
+    from gql.dsl import DSLSchema, DSLQuery, dsl_gql
+    tokens = get_tokens()
+    if not tokens:
+        sys.exit("Github Token not found. Exiting...")
+    token = tokens[0]
+    limiter = get_rate_limiter(token)
+    transport = get_gql_transport(baseurl,token)
+
+    # use the cached schema when available instead of introspection
+    cached_schema = load_cached_schema(baseurl)
+    if cached_schema != None:
+        client = Client(transport=transport, schema=cached_schema)
+    else:
+        client = Client(transport=transport, fetch_schema_from_transport=True)
+
+    # github query doc - https://docs.github.com/en/graphql/reference/queries
+    result = {}
+    with client as gqlsession:
+        assert client.schema is not None
+        session = RateLimitedSession(gqlsession, limiter, retries)
+        if cached_schema == None:
+            save_cached_schema(baseurl,client.schema)
+        # Instantiate the root of the DSL Schema as ds
+        ds = DSLSchema(client.schema)
+        # Create the query using dynamically generated attributes from ds
+        query = dsl_gql(
+            DSLQuery(
+                Login=ds.Query.viewer.select(
+                    ds.User.login
+                ),
+                RateLimit=ds.Query.rateLimit.select(
+                    *rate_limit_fields(ds)
+                )
+            )
+        )
+
+        result = execute_within_budget(session, query)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Success : {json.dumps(result)}")
+        writer = get_result_writer()
+        store = RepositoryStore(sync_db) if sync_db != None else None
+        try:
+            if command == 'crawl':
+                # crawl every owner with the pool of tokens
+                start = time.perf_counter()
+                summary = crawl_owners(baseurl, tokens, client.schema, owners, page_size, writer, store)
+                failed = [name for name, count in summary.items() if count == "Failed"]
+                crawled = sum(count for count in summary.values() if count != "Failed")
+                print(f"Crawled {crawled} repositories of {len(summary) - len(failed)} owners with {len(tokens)} tokens in {round(time.perf_counter() - start, 1)}s\n")
+                if failed:
+                    print(f"Failed owners: {', '.join(failed)}\n")
+            elif command == 'hydrate':
+                # more fields for the given repositories
+                nodes = hydrate_nodes(session, ds, ids, fields)
+                for node in nodes:
+                    if isinstance(node, dict):
+                        if writer == None:
+                            print(json.dumps(node, indent=2))
+                        else:
+                            writer.write(node)
+                missing = sum(1 for node in nodes if not isinstance(node, dict))
+                print(f"Hydrated {len(nodes) - missing} of {len(nodes)} repositories\n")
+            elif command == 'query':
+                # a query file, split or read in pages when it is over the node budget
+                data = execute_within_budget(session, document, variables)
+                if writer == None:
+                    print(json.dumps(data, indent=2))
+                else:
+                    write_result(writer, data)
+            elif command == 'sync':
+                # incremental sync, only the changed repositories are fetched and written
+                owner_key = owner or result['Login']['login']
+                synced = sync_repositories(session, ds, store, owner_key, owner, page_size, result, writer)
+                print(f"Synced {synced} repositories of {owner_key}, {store.count(owner_key)} stored on {sync_db}\n")
+            else:
+                # stream all repositories page by page
+                for repo in iter_repositories(session, ds, owner, page_size, result):
+                    if writer == None:
+                        print_repository(repo)
+                    else:
+                        writer.write(repo)
+        finally:
+            if store != None:
+                store.close()
+        if writer != None:
+            writer.close()
+            if isinstance(writer, ColumnarWriter):
+                print(f"Exported {writer.count} repositories to {len(writer.files)} files on {writer.path}\n")
+    if command == 'crawl':
+        for index, token in enumerate(tokens):
+            status = get_rate_limiter(token).status()
+            print(f"Rate Limits token {index + 1}:\n Limit: {status['limit']}\n Remaining: {status['remaining']}\n")
+    else:
+        print(f"Rate Limits:\n Cost: {result['RateLimit']['cost']}\n Limit: {result['RateLimit']['limit']}\n Used: {result['RateLimit']['used']}\n Remaining: {result['RateLimit']['remaining']}\n ResetAt: {result['RateLimit']['resetAt']}\n")
+
+def print_query_cost(path,variables=None,budget=None):
+    # offline estimate of a query file, no token or network needed
+    from graphql import parse
+    if budget == None:
+        budget = query_node_budget()
+    with open(path, encoding='utf-8') as f:
+        document = parse(f.read())
+    estimate = query_cost(document, variables)
+    print(f"Query {path}:\n Nodes: {estimate['nodeCount']}\n Cost: {estimate['cost']}\n Budget: {budget}\n")
+    for index, (part, part_variables, pages) in enumerate(split_query(document, variables, budget)):
+        if pages == None:
+            print(f" Part {index + 1}: {query_cost(part, part_variables)['nodeCount']} nodes")
+        else:
+            print(f" Part {index + 1}: {query_cost(part, part_variables)['nodeCount']} nodes per page, {'.'.join(pages['path'])} read {pages['size']} at a time")
+
+def startup_benchmark(budget=None,runs=5):
+    # import time of this module on fresh interpreters (-X importtime) and wall time of --help
+    # fails when the median import time is over budget milliseconds
+    import subprocess
+    import statistics
+    if budget == None:
+        budget = float(os.environ.get('STARTUP_BUDGET_MS',50))
+    directory = os.path.dirname(os.path.abspath(__file__))
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    code = f"import sys; sys.path.insert(0, {directory!r}); import {module}"
+    imports = []
+    dependencies = {}
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+        if output.returncode != 0:
+            sys.exit(f"Error Importing {module}:\n{output.stderr}")
+        children = {}
+        for line in output.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package, children come before their parent
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            _, cumulative, name = line.split('|')
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            if depth == 1:
+                children[name.strip()] = int(cumulative)
+            elif depth == 0:
+                if name.strip() == module:
+                    imports.append(int(cumulative) / 1000)
+                    for child, micros in children.items():
+                        dependencies.setdefault(child, []).append(micros / 1000)
+                children = {}
+    helps = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--help'], capture_output=True)
+        helps.append((time.perf_counter() - start) * 1000)
+    median = statistics.median(imports)
+    print(f"Startup:\n Import {module}: {round(median, 2)}ms (budget {budget}ms)\n Run --help: {round(statistics.median(helps), 1)}ms\n")
+    slowest = sorted(dependencies.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:5]
+    for name, times in slowest:
+        print(f" {name}: {round(statistics.median(times), 2)}ms")
+    if median > budget:
+        sys.exit(f"Import of {module} takes {round(median, 2)}ms, over the budget of {budget}ms")
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="GitHub repositories with the GraphQL api")
+    subparsers = parser.add_subparsers(dest='command')
+    repos = subparsers.add_parser('repos', help="list the repositories of the viewer or of an owner")
+    repos.add_argument('--owner', default=os.environ.get('GITHUB_OWNER',None), help="user or organization, the viewer when not set")
+    sync = subparsers.add_parser('sync', help="incremental sync of the repositories to a sqlite file")
+    sync.add_argument('--owner', default=os.environ.get('GITHUB_OWNER',None), help="user or organization, the viewer when not set")
+    sync.add_argument('--db', default=os.environ.get('SYNC_DB','repos.db'), help="sqlite file")
+    crawl = subparsers.add_parser('crawl', help="repositories of many owners with the pool of tokens")
+    crawl.add_argument('--owners', default=None, help="comma separated owners, GITHUB_OWNERS when not set")
+    crawl.add_argument('--owners-file', default=None, help="file with one owner per line, OWNERS_FILE when not set")
+    crawl.add_argument('--db', default=os.environ.get('SYNC_DB',None), help="sqlite file for an incremental crawl")
+    hydrate = subparsers.add_parser('hydrate', help="more fields for repositories by their global node id")
+    hydrate.add_argument('--ids', default=None, help="comma separated node ids")
+    hydrate.add_argument('--ids-file', default=None, help="file with one node id per line")
+    hydrate.add_argument('--fields', default=os.environ.get('HYDRATE_FIELDS','nameWithOwner,description,stargazerCount,forkCount,isArchived,pushedAt'), help="comma separated repository fields")
+    for subparser in (repos, sync, crawl):
+        subparser.add_argument('--page-size', type=int, default=int(os.environ.get('PAGE_SIZE',100)))
+    query = subparsers.add_parser('query', help="run a query file, split within the node budget")
+    query.add_argument('query', help="file with the graphql query")
+    query.add_argument('--variables', type=json.loads, default=None, help="json object with the variables")
+    cost = subparsers.add_parser('cost', help="estimate the node count and cost of a query file")
+    cost.add_argument('query', help="file with the graphql query")
+    cost.add_argument('--variables', type=json.loads, default=None, help="json object with the variables")
+    cost.add_argument('--budget', type=int, default=None, help="node budget, QUERY_NODE_BUDGET when not set")
+    startup = subparsers.add_parser('startup', help="benchmark the import and startup time")
+    startup.add_argument('--budget', type=float, default=None, help="import budget in milliseconds, STARTUP_BUDGET_MS when not set")
+    startup.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.command == 'cost':
+        try:
+            print_query_cost(args.query, args.variables, args.budget)
+        except ValueError as e:
+            sys.exit(f"Error Estimating query : {e}")
+        return
+    if args.command == 'startup':
+        startup_benchmark(args.budget, args.runs)
+        return
+    if args.command == None:
+        # without a command the environment picks it, as before the subcommands
+        if get_owners():
+            args = parser.parse_args(['crawl'])
+        elif os.environ.get('SYNC_DB',None) != None:
+            args = parser.parse_args(['sync'])
+        else:
+            args = parser.parse_args(['repos'])
+    config()
+    set_logger()
+    if args.command == 'crawl':
+        owners = get_owners(args.owners, args.owners_file)
+        if not owners:
+            sys.exit("No owners to crawl. Exiting...")
+        run('crawl', owners=owners, page_size=args.page_size, sync_db=args.db)
+    elif args.command == 'hydrate':
+        ids = [node_id.strip() for node_id in (args.ids or '').split(',') if node_id.strip()]
+        if args.ids_file != None:
+            with open(args.ids_file, encoding='utf-8') as f:
+                ids += [line.strip() for line in f if line.strip()]
+        if not ids:
+            sys.exit("No node ids to hydrate. Exiting...")
+        run('hydrate', ids=ids, fields=[field.strip() for field in args.fields.split(',') if field.strip()])
+    elif args.command == 'query':
+        from graphql import parse
+        with open(args.query, encoding='utf-8') as f:
+            document = parse(f.read())
+        run('query', document=document, variables=args.variables)
+    else:
+        try:
+            run(args.command, owner=args.owner, page_size=args.page_size, sync_db=getattr(args, 'db', None))
+        except OwnerNotFound as e:
+            sys.exit(f"Error Listing repositories : {e}")
+
+if __name__ == "__main__":
+    main()
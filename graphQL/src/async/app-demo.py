@@ -1,17 +1,31 @@
 import os
+import sys
 import json
 import urllib3
 import logging
 import http
 import ssl
 import asyncio
+import aiohttp
 from aiohttp import BasicAuth
 import socket
+import time
+import hashlib
+from collections import OrderedDict
 import backoff
+from graphql import ExecutionResult, validate
 from gql import Client
-from gql.dsl import DSLSchema, DSLQuery, DSLFragment, dsl_gql, print_ast
+from gql.dsl import DSLSchema, DSLQuery, DSLFragment, DSLVariableDefinitions, dsl_gql, print_ast
 from gql.transport.aiohttp import AIOHTTPTransport
-from gql.transport.exceptions import TransportQueryError
+from gql.transport.exceptions import TransportClosed, TransportProtocolError, TransportQueryError, TransportServerError
+
+# helpers shared with the other demo and githubGraphQL/app.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gql_helpers import (
+    get_request_metrics, instrument_validation, get_json_codec, accept_encoding,
+    httpx_transport_args, load_cached_schema, save_cached_schema, get_response_cache,
+    get_result_writers
+)
 
 def config():
     # set keepalive
@@ -58,7 +72,178 @@ def set_logger():
 def print_to_log(*args):
     logger.debug(" ".join(args))
 
-async def get_gql_transport(endpoint,access_token):
+def get_trace_config(metrics):
+    # aiohttp creates the connection (tcp and tls) in a single step, so tls time is part of connect
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+        context.dns = 0
+
+    async def on_dns_resolvehost_start(session, context, params):
+        context.dns_start = time.perf_counter()
+
+    async def on_dns_resolvehost_end(session, context, params):
+        context.dns = time.perf_counter() - context.dns_start
+        metrics.observe('dns', context.dns)
+
+    async def on_connection_create_start(session, context, params):
+        context.connect_start = time.perf_counter()
+
+    async def on_connection_create_end(session, context, params):
+        metrics.observe('connect', time.perf_counter() - context.connect_start - context.dns)
+
+    async def on_request_end(session, context, params):
+        # called when the response headers arrive
+        ttfb = time.perf_counter() - context.start
+        metrics.observe('ttfb', ttfb)
+        logger.debug(f"REQUEST TIMINGS: {params.url} status {params.response.status} ttfb {ttfb:.4f}s")
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+def get_response_class(codec, metrics=None):
+    # gql reads and decodes the body with response.json(), decode it with codec
+    # with metrics the time is split in download and decode
+    class CodecClientResponse(aiohttp.ClientResponse):
+        async def json(self, *, loads=None, **kwargs):
+            start = time.perf_counter()
+            await self.read()
+            downloaded = time.perf_counter()
+            if metrics != None:
+                metrics.observe('download', downloaded - start)
+            try:
+                return await super().json(loads=loads or codec.loads, **kwargs)
+            finally:
+                if metrics != None:
+                    metrics.observe('decode', time.perf_counter() - downloaded)
+    return CodecClientResponse
+
+def persisted_query_error(result):
+    # APQ servers answer with an error when they do not know the hash or do not support persisted queries
+    for error in result.get("errors") or []:
+        code = (error.get("extensions") or {}).get("code")
+        if error.get("message") == "PersistedQueryNotFound" or code == "PERSISTED_QUERY_NOT_FOUND":
+            return "PersistedQueryNotFound"
+        if error.get("message") == "PersistedQueryNotSupported" or code == "PERSISTED_QUERY_NOT_SUPPORTED":
+            return "PersistedQueryNotSupported"
+    return None
+
+def persisted_query_params(payload):
+    # on GET every field goes on the query string, objects as json
+    return {
+        key: value if isinstance(value, str) else json.dumps(value, separators=(',',':'))
+        for key, value in payload.items()
+    }
+
+class PersistedQueryTransport(AIOHTTPTransport):
+    # automatic persisted queries (APQ): the query is sent only as its sha256 hash and sent in full
+    # when the server answers PersistedQueryNotFound, with use_get the hashed requests can be cached by a CDN
+    def __init__(self, *args, use_get=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.use_get = use_get
+        self.persisted_supported = True
+        self.persisted_queries = OrderedDict()
+
+    def persisted_query(self, document):
+        # the printed query and its hash are computed once per document
+        key = id(document)
+        entry = self.persisted_queries.get(key)
+        if entry != None and entry[0] is document:
+            self.persisted_queries.move_to_end(key)
+            return entry[1], entry[2]
+        query_str = print_ast(document)
+        query_hash = hashlib.sha256(query_str.encode('utf-8')).hexdigest()
+        self.persisted_queries[key] = (document, query_str, query_hash)
+        while len(self.persisted_queries) > 1000:
+            self.persisted_queries.popitem(last=False)
+        return query_str, query_hash
+
+    async def execute(self, document, variable_values=None, operation_name=None, extra_args=None, upload_files=False):
+        if upload_files or not self.persisted_supported:
+            return await super().execute(document, variable_values, operation_name, extra_args, upload_files)
+        query_str, query_hash = self.persisted_query(document)
+        payload = {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": query_hash}}}
+        if variable_values:
+            payload["variables"] = variable_values
+        if operation_name:
+            payload["operationName"] = operation_name
+        result = await self.send_payload(payload, self.use_get, extra_args)
+        error = persisted_query_error(result)
+        if error == "PersistedQueryNotSupported":
+            logger.warning(f"Persisted queries not supported by {self.url}, sending full queries")
+            self.persisted_supported = False
+            return await super().execute(document, variable_values, operation_name, extra_args)
+        if error == "PersistedQueryNotFound":
+            # register the query on the server, always with POST since the query may not fit on the url
+            logger.debug(f"Persisted query {query_hash} not found, sending full query")
+            payload["query"] = query_str
+            result = await self.send_payload(payload, False, extra_args)
+        return ExecutionResult(
+            errors=result.get("errors"),
+            data=result.get("data"),
+            extensions=result.get("extensions")
+        )
+
+    async def send_payload(self, payload, use_get, extra_args):
+        if self.session is None:
+            raise TransportClosed("Transport is not connected")
+        if use_get:
+            method = 'GET'
+            request_args = {"params": persisted_query_params(payload)}
+        else:
+            method = 'POST'
+            request_args = {"json": payload}
+        if extra_args:
+            request_args.update(extra_args)
+        async with self.session.request(method, self.url, ssl=self.ssl, **request_args) as resp:
+            self.response_headers = resp.headers
+            try:
+                result = await resp.json(content_type=None)
+            except Exception:
+                result = None
+            if result is None:
+                try:
+                    resp.raise_for_status()
+                except aiohttp.ClientResponseError as e:
+                    raise TransportServerError(str(e), e.status) from e
+                raise TransportProtocolError(f"Server did not return a GraphQL result: Not a JSON answer: {await resp.text()}")
+        if "errors" not in result and "data" not in result:
+            raise TransportProtocolError(f"Server did not return a GraphQL result: No \"data\" or \"errors\" keys in answer: {result}")
+        return result
+
+# httpx
+def get_codec_hook(codec):
+    # httpx response hook decoding response.json() with codec
+    async def decode_response(response):
+        response.json = lambda **kwargs: codec.loads(response.content)
+    return decode_response
+
+def get_httpx_transport(endpoint,headers,ssl_context,metrics=None):
+    # HTTPX transport, with HTTP/2 the concurrent queries of execute_queries share one multiplexed connection
+    import httpx
+    from gql.transport.httpx import HTTPXAsyncTransport
+    if metrics != None:
+        logger.warning("Request timings are recorded only with the aiohttp transport")
+    if os.environ.get('PERSISTED_QUERIES','False') in ("True", "true"):
+        logger.warning("Persisted queries are sent only with the aiohttp transport")
+    codec = get_json_codec()
+    return HTTPXAsyncTransport(
+        url=endpoint,
+        headers=headers,
+        timeout=120,
+        json_serialize=codec.dumps,
+        transport=httpx.AsyncHTTPTransport(**httpx_transport_args(endpoint, ssl_context, 3)),
+        event_hooks={"response": [get_codec_hook(codec)]},
+        trust_env=False
+    )
+
+async def get_gql_transport(endpoint,access_token,metrics=None):
     logger.warning("Setting up gql transport")
     # certificate
     cert = os.environ.get('CERTIFICATE',None)
@@ -70,15 +255,36 @@ async def get_gql_transport(endpoint,access_token):
     else:
         ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
         ssl_context.load_verify_locations(cert)
+    headers={"Accept-Encoding": accept_encoding()}
     if access_token !=None:
-        headers={"Authorization": f"Bearer {access_token}"}
+        headers["Authorization"] = f"Bearer {access_token}"
+    # export GQL_TRANSPORT='httpx' to use HTTPX with HTTP/2 instead of aiohttp
+    if os.environ.get('GQL_TRANSPORT','aiohttp') == 'httpx':
+        return get_httpx_transport(endpoint, headers, ssl_context, metrics)
+    # json codec for the requests and responses, record the request timings on metrics
+    codec = get_json_codec()
+    client_session_args = {
+        "response_class": get_response_class(codec, metrics)
+    }
+    if metrics != None:
+        client_session_args["trace_configs"] = [get_trace_config(metrics)]
+    # export PERSISTED_QUERIES='True' to send the queries as automatic persisted queries
+    transport_args = {}
+    persisted = os.environ.get('PERSISTED_QUERIES','False')
+    if persisted == "True" or persisted == "true":
+        use_get = os.environ.get('PERSISTED_QUERIES_GET','False')
+        transport_args["use_get"] = use_get == "True" or use_get == "true"
+        transport_class = PersistedQueryTransport
     else:
-        headers=None
+        transport_class = AIOHTTPTransport
     # Set up the HTTP transport with your access token
-    transport = AIOHTTPTransport(
+    transport = transport_class(
         url=endpoint,
         headers=headers,
-        ssl=(ssl_context)
+        ssl=(ssl_context),
+        client_session_args=client_session_args,
+        json_serialize=codec.dumps,
+        **transport_args
     )
     # set proxy different from environment
     prox = os.environ.get('SET_PROXY',None)
@@ -97,13 +303,14 @@ async def get_gql_transport(endpoint,access_token):
         transport.auth = proxyauth
     return transport
 
-async def get_gql_client(transport,fetch_schema):
+async def get_gql_client(transport,fetch_schema,schema=None):
     logger.warning("Setting up gql client")
     # Here wait maximum 5 minutes between connection retries
     try:
-        # establish and fetch schema using introspection
+        # establish and fetch schema using introspection unless a schema was provided
         gqlclient = Client(
             transport=transport,
+            schema=schema,
             fetch_schema_from_transport=fetch_schema
         )
     except Exception as e:
@@ -138,11 +345,52 @@ async def get_gql_session(client,recon):
         gqlsession = 'Failed'
     return gqlsession
 
+# compiled query templates, each shape is built and validated only once
+# callers only pass the variable values on execute
+query_templates = {}
+
+def get_query_template(ds,name,schema):
+    # schema is the schema of the client (gqlclient.schema) the templates are validated against
+    if name in query_templates:
+        return query_templates[name]
+    builders = {
+        'GetContinents': query_continents,
+        'GetCountryByCode': query_contry_by_code,
+        'GetCountriesonContinent': query_contries_on_continent
+    }
+    query = builders[name](ds)
+    if query != "Failed":
+        errors = validate(schema, query)
+        if errors:
+            logger.error(f"Error Validating query {name} : {errors[0]}")
+            query = "Failed"
+        else:
+            logger.warning(f"Compiled query template {name}")
+            query_templates[name] = query
+    return query
+
+def skip_template_validation(gqlclient):
+    # templates were validated when compiled, gql does not need to validate them on every execute
+    # batch documents are validated the first time they are sent
+    validate_document = gqlclient.validate
+    validated = set()
+    def validate_once(document):
+        for template in query_templates.values():
+            if document is template:
+                return
+        if id(document) in validated:
+            return
+        validate_document(document)
+        for template in batch_templates.values():
+            if document is template:
+                validated.add(id(document))
+    gqlclient.validate = validate_once
+
 def query_continents(ds):
     logger.warning("Creating gql query for continents")
     try:
         query = dsl_gql(
-            DSLQuery(
+            GetContinents=DSLQuery(
                 GetContinents=ds.Query.continents.select(
                     ds.Continent.code,
                     ds.Continent.name
@@ -155,40 +403,158 @@ def query_continents(ds):
     # else:
     return query
 
-def query_contry_by_code(ds,code):
-    logger.warning(f"Creating gql query for country code {code}")
+def country_selection(ds):
+    # fields selected for a country, shared by the single and batched lookups
+    return (
+        ds.Country.continent.select(
+            ds.Continent.name
+        ),
+        ds.Country.name,
+        ds.Country.capital,
+        ds.Country.currency,
+        ds.Country.languages.select(
+            ds.Language.code,
+            ds.Language.name
+        )
+    )
+
+def query_contry_by_code(ds):
+    logger.warning("Creating gql query for country code")
     try:
-        class DSLVariableDefinitions:
-            countrycode = code
+        # variables: {"code": "IE"}
+        var = DSLVariableDefinitions()
+        query_by_code = DSLQuery(
+            GetCountryByCode=ds.Query.country.args(
+                code=var.code
+            ).select(
+                *country_selection(ds)
+            )
+        )
+        query_by_code.variable_definitions = var
         query = dsl_gql(
-            DSLQuery(
-                GetCountryByCode=ds.Query.country.args(
-                    code=DSLVariableDefinitions.countrycode
-                ).select(
-                    ds.Country.continent.select(
-                        ds.Continent.name
-                    ),
-                    ds.Country.name,
-                    ds.Country.capital,
-                    ds.Country.currency,
-                    ds.Country.languages.select(
-                        ds.Language.code,
-                        ds.Language.name
-                    )
+            GetCountryByCode=query_by_code
+        )
+    except Exception as e:
+        logger.error(f"Error Generating query : {e}")
+        query = "Failed"
+    # else:
+    return query
+
+# batch queries by number of lookups, batches of the same size send the same document with other variables
+# so it is validated once and keeps the same persisted query hash
+batch_templates = {}
+
+def query_countries_by_codes(ds,count):
+    # one aliased field per country with its own variable, e.g. c0: country(code: $c0) {...}
+    # variables: {"c0": "IE", "c1": "PT"}
+    if count in batch_templates:
+        return batch_templates[count]
+    try:
+        var = DSLVariableDefinitions()
+        fields = []
+        for index in range(count):
+            fields.append(
+                ds.Query.country.args(
+                    code=getattr(var, f"c{index}")
+                ).alias(f"c{index}").select(
+                    *country_selection(ds)
                 )
             )
+        query_by_codes = DSLQuery(*fields)
+        query_by_codes.variable_definitions = var
+        query = dsl_gql(
+            GetCountriesByCodes=query_by_codes
         )
     except Exception as e:
         logger.error(f"Error Generating query : {e}")
         query = "Failed"
-    # else:
+    else:
+        batch_templates[count] = query
     return query
 
-def query_contries_on_continent(ds,code):
-    logger.warning(f"Creating gql query for countries on continent code {code}")
+class CountryBatchLoader:
+    # collects country lookups and sends them as a single aliased query
+    # a batch is sent when it reaches batch_max lookups or batch_interval seconds after the first one
+    def __init__(self, ds, session, batch_max=None, batch_interval=None):
+        self.ds = ds
+        self.session = session
+        if batch_max == None:
+            batch_max = int(os.environ.get('BATCH_MAX',50))
+        if batch_interval == None:
+            batch_interval = float(os.environ.get('BATCH_INTERVAL',0.01))
+        self.batch_max = batch_max
+        self.batch_interval = batch_interval
+        self.pending = {}
+        self.handle = None
+        self.tasks = set()
+
+    def load(self, code):
+        # returns a future with the country, repeated codes share the same lookup
+        if code in self.pending:
+            return self.pending[code]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[code] = future
+        if len(self.pending) >= self.batch_max:
+            self.flush()
+        elif self.handle == None:
+            self.handle = loop.call_later(self.batch_interval, self.flush)
+        return future
+
+    async def load_many(self, codes):
+        futures = [self.load(code) for code in codes]
+        self.flush()
+        return await asyncio.gather(*futures)
+
+    def flush(self):
+        if self.handle != None:
+            self.handle.cancel()
+            self.handle = None
+        batch = self.pending
+        self.pending = {}
+        if batch:
+            task = asyncio.ensure_future(self.dispatch(batch))
+            # keep a reference until the batch is done
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def dispatch(self, batch):
+        logger.warning(f"Executing batch of {len(batch)} country lookups")
+        query = query_countries_by_codes(self.ds, len(batch))
+        # the alias and the variable of every lookup are both c<index>
+        variables = {f"c{index}": code for index, code in enumerate(batch)}
+        if query == "Failed":
+            for future in batch.values():
+                future.set_exception(ValueError("Error Generating batch query"))
+            return
+        errors = {}
+        try:
+            data = await self.session.execute(query, variable_values=variables)
+        except TransportQueryError as e:
+            # split partial errors back to the lookups that caused them
+            data = e.data or {}
+            for error in e.errors or []:
+                path = error.get('path') or [None]
+                errors[path[0]] = error.get('message')
+            if None in errors:
+                data = {}
+        except Exception as e:
+            logger.error(f"Error Executing batch query : {e}")
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for alias, code in variables.items():
+            if alias in errors or alias not in data:
+                message = errors.get(alias, errors.get(None, "no data returned"))
+                batch[code].set_exception(TransportQueryError(f"Error on country {code}: {message}"))
+            else:
+                batch[code].set_result(data[alias])
+
+def query_contries_on_continent(ds):
+    logger.warning("Creating gql query for countries on continent code")
     try:
-        class DSLVariableDefinitions:
-            continentcode = code
+        # variables: {"code": "OC"}
+        var = DSLVariableDefinitions()
         countryinfo = DSLFragment("CountryInfo")
         countryinfo.on(ds.Country)
         countryinfo.select(
@@ -199,7 +565,7 @@ def query_contries_on_continent(ds,code):
         )
         query_with_fragment = DSLQuery(
             GetCountriesonContinent=ds.Query.continent.args(
-                code=DSLVariableDefinitions.continentcode
+                code=var.code
             ).select(
                 ds.Continent.code,
                 ds.Continent.name,
@@ -208,9 +574,10 @@ def query_contries_on_continent(ds,code):
                 )
             )
         )
+        query_with_fragment.variable_definitions = var
         query = dsl_gql(
             countryinfo,
-            query_with_fragment
+            GetCountriesonContinent=query_with_fragment
         )
     except Exception as e:
         logger.error(f"Error Generating query : {e}")
@@ -218,20 +585,78 @@ def query_contries_on_continent(ds,code):
     # else:
     return query
 
-async def execute_query(query, session):
+async def execute_query(query, session, variables=None, cache=None, ttl=None):
     logger.warning("Executing gql query")
+    if cache != None:
+        key = cache.key(query, variables)
+        result = cache.get(key)
+        if result != None:
+            return result
     # Execute the query
     try:
-        result = await session.execute(query)
+        result = await session.execute(query, variable_values=variables)
     except Exception as e:
-        logger.error(f"Error Executing query : {e}\nError: {json.dumps(result['errors'])}\nHeaders: {result['headers']}")
+        logger.error(f"Error Executing query : {e}\nError: {json.dumps(getattr(e, 'errors', None))}")
         result = "Failed"
+    else:
+        if cache != None:
+            cache.set(key, result, ttl if ttl != None else cache.ttl_for(query))
     return result
 
+async def execute_queries(jobs, session, concurrency=None, cache=None):
+    # run a list of (query, variables) jobs concurrently on the same session
+    # results keep the jobs order and a failed job returns "Failed" without stopping the others
+    if concurrency == None:
+        concurrency = int(os.environ.get('MAX_CONCURRENCY',10))
+    logger.warning(f"Executing {len(jobs)} gql queries with concurrency {concurrency}")
+    semaphore = asyncio.Semaphore(concurrency)
+    async def execute_job(index, query, variables):
+        if cache != None:
+            key = cache.key(query, variables)
+            result = cache.get(key)
+            if result != None:
+                return result
+        async with semaphore:
+            try:
+                result = await session.execute(query, variable_values=variables)
+            except Exception as e:
+                logger.error(f"Error Executing job {index} with variables {json.dumps(variables)} : {e}")
+                result = "Failed"
+            else:
+                if cache != None:
+                    cache.set(key, result, cache.ttl_for(query))
+        return result
+    results = await asyncio.gather(
+        *[execute_job(index, query, variables) for index, (query, variables) in enumerate(jobs)]
+    )
+    failed = sum(1 for result in results if result == "Failed")
+    if failed > 0:
+        logger.error(f"{failed} of {len(jobs)} gql queries failed")
+    return results
+
 #################################### variables on Environment #####################################################################
 # export USR='username' # proxy username authentication
 # export PSW='password'
 # export SET_PROXY='http://myproxy.com:3128'
+# export SCHEMA_CACHE_DIR='.schema_cache' # directory for the introspection schema cache
+# export SCHEMA_CACHE_TTL='86400' # seconds before the cached schema is fetched again
+# export SCHEMA_REFRESH='False' # use True to ignore the cached schema and refresh it
+# export MAX_CONCURRENCY='10' # maximum queries in flight on execute_queries
+# export BATCH_MAX='50' # maximum lookups merged in a single aliased query
+# export BATCH_INTERVAL='0.01' # seconds to wait for more lookups before sending a batch
+# export RESPONSE_CACHE='False' # use True to cache query results
+# export RESPONSE_CACHE_SIZE='1000' # maximum cached results
+# export RESPONSE_CACHE_TTL='300' # seconds a cached result is valid
+# export RESPONSE_CACHE_DB='responses.db' # sqlite file to share the cache between processes, in memory when not set
+# export OUTPUT_FORMAT='json' # use ndjson or csv to stream the result nodes
+# export OUTPUT_FILE='result.ndjson' # write the results to a file instead of stdout, csv writes result.<query>.csv per query
+# export METRICS_FILE='metrics.prom' # record dns, connect, tls, ttfb, download, decode and validation times (.json for json)
+# export PERSISTED_QUERIES='False' # use True to send queries as automatic persisted queries (sha256 hash)
+# export PERSISTED_QUERIES_GET='False' # use True to send the hashed queries with GET so a CDN can cache them
+# export JSON_CODEC='auto' # orjson, ujson or json to encode and decode the requests, auto uses the first installed
+# export ACCEPT_ENCODING='gzip, br' # compressed responses, br only when brotli is installed
+# export GQL_TRANSPORT='aiohttp' # use httpx to send the queries with HTTPX
+# export HTTP2='True' # HTTP/2 with httpx, needs pip install httpx[http2]
 ###################################################################################################################################
 
 async def main():
@@ -240,64 +665,69 @@ async def main():
     logger = set_logger()
     endpoint = "https://countries.trevorblades.com/graphql"
     # Get transport
-    transport = await get_gql_transport(endpoint,None)
-    gql_client = await get_gql_client(transport,True)
+    metrics = get_request_metrics()
+    transport = await get_gql_transport(endpoint,None,metrics)
+    # use the cached schema when available instead of introspection
+    cached_schema = load_cached_schema(endpoint)
+    gql_client = await get_gql_client(transport,cached_schema == None,cached_schema)
     gql_session = await get_gql_session(gql_client,True)
+    if cached_schema == None and gql_client.schema != None:
+        save_cached_schema(endpoint,gql_client.schema)
     # assert await gqlsession.schema is not None
     # Instantiate the root of the DSL Schema as ds
     ds = DSLSchema(gql_client.schema)
+    skip_template_validation(gql_client)
+    if metrics != None:
+        instrument_validation(gql_client, metrics)
+    response_cache = get_response_cache()
+    # build all jobs first and run them concurrently on the same session
+    jobs = []
     # simple query
-    query = query_continents(ds)
-    if query == "Failed":
-        await gql_session.close_async()
-        await transport.close()
-    else:
-        logger.debug(f"QUERY DATA: {print_ast(query)}")
-        result = await execute_query(query, gql_session)
-        if query == "Failed":
-            await gql_session.close_async()
-            await transport.close()
-        else:
-            logger.debug(f"Success : {json.dumps(result)}")
-            print(f"Result: {json.dumps(result,indent=2)}")
+    jobs.append((get_query_template(ds,'GetContinents',gql_client.schema), None))
     # query with variables
     countrycode="IE"
-    query = query_contry_by_code(ds,countrycode)
-    if query == "Failed":
-        logger.warning("Closing gql client session")
-        await gql_client.close_async()
-        logger.warning("Closing gql transport")
-        await transport.close()
-    else:
-        logger.debug(f"QUERY DATA: {print_ast(query)}")
-        result = await execute_query(query, gql_session)
-        if query == "Failed":
-            logger.warning("Closing gql client session")
-            await gql_client.close_async()
-            logger.warning("Closing gql transport")
-            await transport.close()
-        else:
-            logger.debug(f"Success : {json.dumps(result)}")
-            print(f"Result: {json.dumps(result,indent=2)}")
+    jobs.append((get_query_template(ds,'GetCountryByCode',gql_client.schema), {"code": countrycode}))
     # query with fragment
     continentcode = 'EU'
-    query=query_contries_on_continent(ds,continentcode)
-    if query == "Failed":
-            logger.warning("Closing gql client session")
-            await gql_client.close_async()
-            logger.warning("Closing gql transport")
-            await transport.close()
+    jobs.append((get_query_template(ds,'GetCountriesonContinent',gql_client.schema), {"code": continentcode}))
+    if any(query == "Failed" for query, variables in jobs):
+        logger.error("Error Generating queries, nothing executed")
     else:
-        logger.debug(f"QUERY DATA: {print_ast(query)}")
-        result = await execute_query(query, gql_session)
-        if query == "Failed":
-            logger.warning("Closing gql client session")
-            await gql_client.close_async()
-            logger.warning("Closing gql transport")
-            await transport.close()
+        for query, variables in jobs:
+            logger.debug(f"QUERY DATA: {print_ast(query)}\nVARIABLES: {json.dumps(variables)}")
+        results = await execute_queries(jobs, gql_session, cache=response_cache)
+        # every query returns a different shape, csv writes each one with its own header
+        writers = get_result_writers()
+        for result in results:
+            if result != "Failed":
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Success : {json.dumps(result)}")
+                if writers == None:
+                    print(f"Result: {json.dumps(result,indent=2)}")
+                else:
+                    writers.write_result(result)
+        # many country lookups merged in a single aliased query
+        countrycodes = ['IE','PT','BR']
+        loader = CountryBatchLoader(ds, gql_session)
+        try:
+            countries = await loader.load_many(countrycodes)
+        except Exception as e:
+            logger.error(f"Error on batch lookup : {e}")
         else:
-            logger.debug(f"Success : {json.dumps(result)}")
-            print(f"Result: {json.dumps(result,indent=2)}")
+            for code, country in zip(countrycodes, countries):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Success : {json.dumps(country)}")
+                if writers == None:
+                    print(f"Result {code}: {json.dumps(country,indent=2)}")
+                elif country != None:
+                    writers.write('countries', country)
+        if writers != None:
+            writers.close()
+    if response_cache != None:
+        logger.warning(f"Response cache: {json.dumps(response_cache.stats())}")
+        response_cache.close()
+    if metrics != None:
+        metrics.export(os.environ.get('METRICS_FILE'))
     logger.warning("Closing gql client session")
     await gql_client.close_async()
     logger.warning("Closing gql transport")
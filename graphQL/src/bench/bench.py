@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import argparse
+import asyncio
+import logging
+import resource
+import subprocess
+import importlib.util
+
+from gql import Client
+from gql.dsl import DSLSchema
+
+# offline benchmark of the sync (requests) and async (aiohttp) demos against the local countries server
+# every mode runs on its own process so the peak RSS of one mode does not hide the others
+#
+# python bench.py --requests 500 --concurrency 20 --latency 20
+# python bench.py --output current.json --baseline previous.json --tolerance 0.2
+
+__dirname = os.path.dirname(os.path.abspath(__file__))
+MODES = ['sync', 'threads', 'async', 'batched']
+
+def load_demo(mode):
+    # the demos are scripts (app-demo.py) so they are loaded from their path
+    path = os.path.join(__dirname, '..', mode, 'app-demo.py')
+    spec = importlib.util.spec_from_file_location(f"app_demo_{mode}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.logger = logging.getLogger(f"bench.{mode}")
+    return module
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def country_codes(count, total):
+    # same code generation of the countries server
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return [letters[(index % total) // 26 % 26] + letters[(index % total) % 26] for index in range(count)]
+
+class TimedSession:
+    # wraps a gql session to record the latency of every request sent
+    def __init__(self, session, latencies):
+        self.session = session
+        self.transport = session.transport
+        self.latencies = latencies
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.session.execute(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+class AsyncTimedSession(TimedSession):
+    async def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self.session.execute(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+def run_sync(url, codes, concurrency, threads):
+    demo = load_demo('sync')
+    transport = demo.get_gql_transport(url, None)
+    latencies = []
+    gqlclient = Client(transport=transport, fetch_schema_from_transport=True)
+    with gqlclient as session:
+        ds = DSLSchema(gqlclient.schema)
+        demo.skip_template_validation(gqlclient)
+        query = demo.get_query_template(ds, 'GetCountryByCode', gqlclient.schema)
+        jobs = [(query, {"code": code}) for code in codes]
+        timed = TimedSession(session, latencies)
+        start = time.perf_counter()
+        if threads:
+            results = demo.execute_bulk(jobs, timed, workers=concurrency)
+        else:
+            results = [demo.execute_query(query, timed, variables) for query, variables in jobs]
+        elapsed = time.perf_counter() - start
+    return elapsed, latencies, sum(1 for result in results if result == "Failed")
+
+async def run_async(url, codes, concurrency, batched):
+    demo = load_demo('async')
+    transport = await demo.get_gql_transport(url, None)
+    gqlclient = await demo.get_gql_client(transport, True)
+    session = await demo.get_gql_session(gqlclient, True)
+    latencies = []
+    try:
+        ds = DSLSchema(gqlclient.schema)
+        demo.skip_template_validation(gqlclient)
+        timed = AsyncTimedSession(session, latencies)
+        start = time.perf_counter()
+        if batched:
+            loader = demo.CountryBatchLoader(ds, timed)
+            results = await asyncio.gather(
+                *[loader.load(code) for code in codes], return_exceptions=True
+            )
+            failed = sum(1 for result in results if isinstance(result, Exception))
+        else:
+            query = demo.get_query_template(ds, 'GetCountryByCode', gqlclient.schema)
+            jobs = [(query, {"code": code}) for code in codes]
+            results = await demo.execute_queries(jobs, timed, concurrency)
+            failed = sum(1 for result in results if result == "Failed")
+        elapsed = time.perf_counter() - start
+    finally:
+        await gqlclient.close_async()
+    return elapsed, latencies, failed
+
+def run_mode(args):
+    codes = country_codes(args.requests, min(args.countries, 26 * 26))
+    if args.mode == 'sync':
+        elapsed, latencies, failed = run_sync(args.url, codes, args.concurrency, False)
+    elif args.mode == 'threads':
+        elapsed, latencies, failed = run_sync(args.url, codes, args.concurrency, True)
+    elif args.mode == 'async':
+        elapsed, latencies, failed = asyncio.run(run_async(args.url, codes, args.concurrency, False))
+    else:
+        elapsed, latencies, failed = asyncio.run(run_async(args.url, codes, args.concurrency, True))
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss = maxrss / 1024
+    return {
+        "mode": args.mode,
+        "lookups": len(codes),
+        "requests": len(latencies),
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "lookups_per_second": round(len(codes) / elapsed, 1),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "peak_rss_mb": round(maxrss / 1024, 1)
+    }
+
+def start_server(args):
+    command = [
+        sys.executable, os.path.join(__dirname, 'countries_server.py'),
+        '--latency', str(args.latency),
+        '--countries', str(args.countries),
+        '--languages', str(args.languages)
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line.startswith('listening on '):
+        server.kill()
+        sys.exit(f"Error Starting countries server: {line}")
+    return server, line.split('listening on ')[1].strip()
+
+def compare(results, baseline, tolerance):
+    # fails when lookups per second dropped more than tolerance from the baseline
+    regressions = []
+    previous = {result['mode']: result for result in baseline}
+    for result in results:
+        if result['mode'] not in previous:
+            continue
+        expected = previous[result['mode']]['lookups_per_second'] * (1 - tolerance)
+        if result['lookups_per_second'] < expected:
+            regressions.append(
+                f"{result['mode']}: {result['lookups_per_second']} lookups/s is below {round(expected, 1)}"
+            )
+    return regressions
+
+def print_table(results):
+    columns = ['mode', 'lookups', 'requests', 'failed', 'lookups_per_second', 'requests_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb']
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(str(result[column]) for column in columns))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the GraphQL demos")
+    parser.add_argument('--modes', default=",".join(MODES), help=f"comma separated list of {MODES}")
+    parser.add_argument('--requests', type=int, default=200, help="country lookups per mode")
+    parser.add_argument('--concurrency', type=int, default=10, help="threads or queries in flight")
+    parser.add_argument('--latency', type=float, default=10, help="server latency per request in milliseconds")
+    parser.add_argument('--countries', type=int, default=250, help="countries generated by the server")
+    parser.add_argument('--languages', type=int, default=50, help="languages generated by the server")
+    parser.add_argument('--output', help="write the results to this json file")
+    parser.add_argument('--baseline', help="json results of a previous run to compare")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed throughput drop from the baseline")
+    # internal options used to run a single mode on its own process
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL','ERROR'))
+
+    if args.mode != None:
+        print(json.dumps(run_mode(args)))
+        return
+
+    # the benchmark must not depend on the environment proxy or cache settings
+    env = dict(os.environ)
+    for name in ['SET_PROXY', 'USR', 'PSW', 'RESPONSE_CACHE', 'RESPONSE_CACHE_DB']:
+        env.pop(name, None)
+    server, url = start_server(args)
+    results = []
+    try:
+        for mode in args.modes.split(','):
+            command = [
+                sys.executable, os.path.abspath(__file__),
+                '--mode', mode,
+                '--url', url,
+                '--requests', str(args.requests),
+                '--concurrency', str(args.concurrency),
+                '--countries', str(args.countries)
+            ]
+            output = subprocess.run(command, capture_output=True, text=True, env=env)
+            if output.returncode != 0:
+                sys.exit(f"Error Running mode {mode}:\n{output.stderr}")
+            results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    finally:
+        server.terminate()
+        server.wait()
+    print_table(results)
+    if args.output != None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline != None:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit("Regressions found:\n" + "\n".join(regressions))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import gzip
+import string
+import argparse
+import logging
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from graphql import build_schema, graphql_sync
+
+# local stand-in of https://countries.trevorblades.com/graphql with the types used on the demos
+# the data is generated so the payload size can be changed and no network access is needed
+
+SCHEMA = '''
+type Query {
+  continents(filter: ContinentFilterInput): [Continent!]!
+  continent(code: ID!): Continent
+  countries(filter: CountryFilterInput): [Country!]!
+  country(code: ID!): Country
+  languages(filter: LanguageFilterInput): [Language!]!
+  language(code: ID!): Language
+}
+
+input StringQueryOperatorInput {
+  eq: String
+  ne: String
+  in: [String!]
+  nin: [String!]
+  regex: String
+}
+
+input ContinentFilterInput {
+  code: StringQueryOperatorInput
+}
+
+input CountryFilterInput {
+  code: StringQueryOperatorInput
+  currency: StringQueryOperatorInput
+  continent: StringQueryOperatorInput
+  name: StringQueryOperatorInput
+}
+
+input LanguageFilterInput {
+  code: StringQueryOperatorInput
+}
+
+type Continent {
+  code: ID!
+  name: String!
+  countries: [Country!]!
+}
+
+type Country {
+  code: ID!
+  name: String!
+  native: String!
+  phone: String!
+  capital: String
+  currency: String
+  emoji: String!
+  emojiU: String!
+  continent: Continent!
+  languages: [Language!]!
+}
+
+type Language {
+  code: ID!
+  name: String!
+  native: String!
+  rtl: Boolean!
+}
+'''
+
+CONTINENTS = {
+    'AF': 'Africa',
+    'AN': 'Antarctica',
+    'AS': 'Asia',
+    'EU': 'Europe',
+    'NA': 'North America',
+    'OC': 'Oceania',
+    'SA': 'South America'
+}
+
+def build_data(countries, languages):
+    # countries get two letter codes (AA, AB, ...) spread over the continents
+    data_languages = [
+        {"code": f"l{index}", "name": f"Language {index}", "native": f"Native {index}", "rtl": index % 7 == 0}
+        for index in range(max(languages, 1))
+    ]
+    data_continents = {
+        code: {"code": code, "name": name, "countries": []}
+        for code, name in CONTINENTS.items()
+    }
+    continent_codes = list(CONTINENTS)
+    data_countries = {}
+    letters = string.ascii_uppercase
+    for index in range(countries):
+        code = letters[(index // 26) % 26] + letters[index % 26]
+        if index >= 26 * 26:
+            code = f"{code}{index // (26 * 26)}"
+        continent = data_continents[continent_codes[index % len(continent_codes)]]
+        country = {
+            "code": code,
+            "name": f"Country {code}",
+            "native": f"Native {code}",
+            "phone": str(index),
+            "capital": f"Capital {code}",
+            "currency": "EUR" if index % 2 == 0 else "USD",
+            "emoji": code,
+            "emojiU": code,
+            "continent": continent,
+            "languages": [data_languages[(index + offset) % len(data_languages)] for offset in range(min(languages, 3))]
+        }
+        data_countries[code] = country
+        continent["countries"].append(country)
+    return data_continents, data_countries, data_languages
+
+def match_filter(node, filter):
+    if filter == None:
+        return True
+    for field, operators in filter.items():
+        value = node[field]["code"] if field == 'continent' else node[field]
+        if 'eq' in operators and value != operators['eq']:
+            return False
+        if 'ne' in operators and value == operators['ne']:
+            return False
+        if 'in' in operators and value not in operators['in']:
+            return False
+        if 'nin' in operators and value in operators['nin']:
+            return False
+    return True
+
+class Root:
+    def __init__(self, continents, countries, languages):
+        self.data_continents = continents
+        self.data_countries = countries
+        self.data_languages = languages
+
+    def continents(self, info, filter=None):
+        return [continent for continent in self.data_continents.values() if match_filter(continent, filter)]
+
+    def continent(self, info, code):
+        return self.data_continents.get(code)
+
+    def countries(self, info, filter=None):
+        return [country for country in self.data_countries.values() if match_filter(country, filter)]
+
+    def country(self, info, code):
+        return self.data_countries.get(code)
+
+    def languages(self, info, filter=None):
+        return [language for language in self.data_languages if match_filter(language, filter)]
+
+    def language(self, info, code):
+        for language in self.data_languages:
+            if language["code"] == code:
+                return language
+        return None
+
+def resolve_field(source, info, **args):
+    # root fields are methods of Root, everything else is a dict
+    if isinstance(source, dict):
+        return source.get(info.field_name)
+    return getattr(source, info.field_name)(info, **args)
+
+class CountriesServer(ThreadingHTTPServer):
+    # keep up with clients opening many connections at once
+    request_queue_size = 256
+    daemon_threads = True
+
+    def __init__(self, address, latency=0, countries=250, languages=50):
+        super().__init__(address, CountriesHandler)
+        self.latency = latency
+        self.schema = build_schema(SCHEMA)
+        self.root = Root(*build_data(countries, languages))
+        self.requests = 0
+        self.persisted_queries = {}
+
+    def persisted_query(self, body):
+        # automatic persisted queries, the query is registered by the first request sending it with its hash
+        persisted = (body.get('extensions') or {}).get('persistedQuery')
+        if persisted == None:
+            return body.get('query'), None
+        query_hash = persisted.get('sha256Hash')
+        query = body.get('query')
+        if query != None:
+            if hashlib.sha256(query.encode('utf-8')).hexdigest() != query_hash:
+                return None, {"message": "provided sha does not match query"}
+            self.persisted_queries[query_hash] = query
+            return query, None
+        if query_hash not in self.persisted_queries:
+            return None, {"message": "PersistedQueryNotFound", "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"}}
+        return self.persisted_queries[query_hash], None
+
+    def execute(self, body):
+        query, error = self.persisted_query(body)
+        if error != None:
+            return {"errors": [error]}
+        result = graphql_sync(
+            self.schema,
+            query,
+            root_value=self.root,
+            variable_values=body.get('variables'),
+            operation_name=body.get('operationName'),
+            field_resolver=resolve_field
+        )
+        response = {"data": result.data}
+        if result.errors:
+            response["errors"] = [error.formatted for error in result.errors]
+        return response
+
+class CountriesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without this every response waits for the delayed ack
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.server.requests += 1
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_json(400, {"errors": [{"message": "Invalid json body"}]})
+            return
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if isinstance(body, list):
+            response = [self.server.execute(item) for item in body]
+        else:
+            response = self.server.execute(body)
+        self.send_json(200, response)
+
+    def do_GET(self):
+        # GET requests carry the fields on the query string, variables and extensions as json
+        self.server.requests += 1
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        try:
+            for key in ['variables', 'extensions']:
+                if key in params:
+                    params[key] = json.loads(params[key])
+        except ValueError:
+            self.send_json(400, {"errors": [{"message": "Invalid json parameter"}]})
+            return
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.send_json(200, self.server.execute(params))
+
+    def send_json(self, status, response):
+        data = json.dumps(response).encode('utf-8')
+        # compress like a real server when the client asks for gzip, small bodies are not worth it
+        compress = len(data) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if compress:
+            data = gzip.compress(data, compresslevel=5)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.getLogger('countries_server').debug(format % args)
+
+def start_server(port=0, latency=0, countries=250, languages=50):
+    server = CountriesServer(('127.0.0.1', port), latency, countries, languages)
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local countries GraphQL server for benchmarks")
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT',0)))
+    parser.add_argument('--latency', type=float, default=0, help="artificial latency per request in milliseconds")
+    parser.add_argument('--countries', type=int, default=250, help="number of generated countries")
+    parser.add_argument('--languages', type=int, default=50, help="number of generated languages")
+    args = parser.parse_args()
+    server = start_server(args.port, args.latency / 1000, args.countries, args.languages)
+    # the benchmark reads the port from the first line
+    print(f"listening on http://127.0.0.1:{server.server_port}/graphql", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.exit(0)
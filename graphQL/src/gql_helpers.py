@@ -0,0 +1,537 @@
+import os
+import sys
+import json
+import time
+import bisect
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# helpers shared by the sync and async demos
+# the scripts add this directory to sys.path before importing it:
+#   sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+#   from gql_helpers import get_json_codec, get_response_cache, ...
+# heavy modules (graphql, gql, httpx, sqlite3, csv) are imported by the functions using them
+# so importing this module keeps the startup of the scripts cheap
+
+logger = logging.getLogger()
+
+# request metrics
+class RequestMetrics:
+    # histograms of the time spent on each phase of the requests (dns, connect, tls, ttfb, download, decode, validation)
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            histogram = self.phases.get(phase)
+            if histogram == None:
+                histogram = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+                self.phases[phase] = histogram
+            histogram["counts"][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def cumulative(self, histogram):
+        total = 0
+        counts = []
+        for count in histogram["counts"]:
+            total += count
+            counts.append(total)
+        return counts
+
+    def to_dict(self):
+        with self.lock:
+            result = {}
+            for phase, histogram in self.phases.items():
+                counts = self.cumulative(histogram)
+                result[phase] = {
+                    "count": histogram["count"],
+                    "sum": round(histogram["sum"], 6),
+                    "avg": round(histogram["sum"] / histogram["count"], 6),
+                    "buckets": {str(le): count for le, count in zip(self.buckets + ("+Inf",), counts)}
+                }
+        return result
+
+    def to_prometheus(self):
+        name = "graphql_request_phase_seconds"
+        lines = [
+            f"# HELP {name} Time spent on each phase of the GraphQL requests",
+            f"# TYPE {name} histogram"
+        ]
+        with self.lock:
+            for phase, histogram in self.phases.items():
+                counts = self.cumulative(histogram)
+                for le, count in zip(self.buckets + ("+Inf",), counts):
+                    lines.append(f'{name}_bucket{{phase="{phase}",le="{le}"}} {count}')
+                lines.append(f'{name}_sum{{phase="{phase}"}} {histogram["sum"]}')
+                lines.append(f'{name}_count{{phase="{phase}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        # json when the file ends with .json, prometheus text format otherwise
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                if path.endswith('.json'):
+                    json.dump(self.to_dict(), f, indent=2)
+                else:
+                    f.write(self.to_prometheus())
+        except Exception as e:
+            logger.error(f"Error Exporting metrics : {e}")
+        else:
+            logger.info(f"Request metrics exported to {path}")
+
+def get_request_metrics():
+    # export METRICS_FILE='metrics.prom' (or .json) to record the request timings
+    if os.environ.get('METRICS_FILE',None) == None:
+        return None
+    return RequestMetrics()
+
+def instrument_validation(gqlclient, metrics):
+    validate_document = gqlclient.validate
+    def timed_validate(document):
+        start = time.perf_counter()
+        try:
+            validate_document(document)
+        finally:
+            metrics.observe('validation', time.perf_counter() - start)
+    gqlclient.validate = timed_validate
+
+# json codec
+class JSONCodec:
+    # dumps returns str and loads takes str or bytes, whatever the library behind it
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+def orjson_codec():
+    import orjson
+    return JSONCodec('orjson', lambda obj: orjson.dumps(obj).decode('utf-8'), orjson.loads)
+
+def ujson_codec():
+    import ujson
+    return JSONCodec('ujson', lambda obj: ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False), ujson.loads)
+
+def stdlib_codec():
+    return JSONCodec('json', lambda obj: json.dumps(obj, separators=(',',':'), ensure_ascii=False), json.loads)
+
+json_codecs = {
+    'orjson': orjson_codec,
+    'ujson': ujson_codec,
+    'json': stdlib_codec
+}
+
+def get_json_codec(name=None):
+    # export JSON_CODEC='orjson', 'ujson' or 'json', with auto the first one installed is used
+    if name == None:
+        name = os.environ.get('JSON_CODEC','auto')
+    names = list(json_codecs) if name == 'auto' else [name]
+    for codec_name in names:
+        try:
+            codec = json_codecs[codec_name]()
+        except (ImportError, KeyError):
+            continue
+        logger.debug(f"Using {codec.name} json codec")
+        return codec
+    logger.warning(f"JSON codec {name} not available, using json")
+    return stdlib_codec()
+
+def accept_encoding():
+    # export ACCEPT_ENCODING to override, br is asked only when a brotli decoder is installed
+    import importlib.util
+    encoding = os.environ.get('ACCEPT_ENCODING',None)
+    if encoding != None:
+        return encoding
+    if importlib.util.find_spec('brotli') != None or importlib.util.find_spec('brotlicffi') != None:
+        return "gzip, br"
+    return "gzip, deflate"
+
+# httpx
+class RetryTransport:
+    # wraps an httpx transport retrying the status codes retried by the requests transport
+    # waits retry-after when the server sends it or an exponential backoff
+    # 403 and the graphql errors are left to the caller (backoff, RateLimitedSession)
+    def __init__(self, transport, retries, backoff_factor=0.1, status_forcelist=(429, 500, 502, 503, 504)):
+        self.transport = transport
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+
+    def handle_request(self, request):
+        attempt = 0
+        while True:
+            response = self.transport.handle_request(request)
+            if response.status_code not in self.status_forcelist or attempt >= self.retries:
+                return response
+            retry_after = response.headers.get('retry-after')
+            response.read()
+            response.close()
+            if retry_after != None and retry_after.isdigit():
+                wait = int(retry_after)
+            else:
+                wait = min(self.backoff_factor * 2 ** attempt, 120)
+            attempt += 1
+            logger.warning(f"Retrying {request.url} after status {response.status_code}, retry {attempt} of {self.retries} in {wait}s")
+            time.sleep(wait)
+
+    def close(self):
+        self.transport.close()
+
+    def __enter__(self):
+        self.transport.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.transport.__exit__(*args)
+
+def httpx_transport_args(endpoint,certverify,retries):
+    # connection settings of the httpx transports
+    # the client does not read the proxy from the environment, it is resolved here so USR/PSW also apply to it
+    import ssl
+    import httpx
+    import importlib.util
+    from urllib.parse import urlparse
+    from urllib.request import getproxies, proxy_bypass
+    # export HTTP2='False' to use HTTP/1.1 with httpx
+    http2 = os.environ.get('HTTP2','True')
+    http2 = http2 == "True" or http2 == "true"
+    if http2 and importlib.util.find_spec('h2') == None:
+        logger.warning("HTTP/2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+        http2 = False
+    if isinstance(certverify, str):
+        certverify = ssl.create_default_context(cafile=certverify)
+    transport_args = {
+        "verify": certverify,
+        "http2": http2,
+        # connection errors, the status codes are retried by RetryTransport or backoff
+        "retries": retries
+    }
+    url = urlparse(endpoint)
+    prox = os.environ.get('SET_PROXY',None)
+    if prox == None and not proxy_bypass(url.hostname):
+        prox = getproxies().get(url.scheme)
+    if prox != None:
+        # Add Proxy authentication
+        user = os.environ.get('USR',None)
+        password = os.environ.get('PSW',None)
+        auth = (user, password) if user != None and password != None else None
+        transport_args["proxy"] = httpx.Proxy(prox, auth=auth)
+    return transport_args
+
+# schema cache
+def schema_cache_file(endpoint):
+    # one cache file per endpoint
+    cache_dir = os.environ.get('SCHEMA_CACHE_DIR','.schema_cache')
+    key = hashlib.sha256(endpoint.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{key}.graphql")
+
+def load_cached_schema(endpoint):
+    # return the cached schema while it is younger than SCHEMA_CACHE_TTL seconds
+    from graphql import build_schema
+    refresh = os.environ.get('SCHEMA_REFRESH','False')
+    if refresh == "True" or refresh == "true":
+        logger.info(f"Schema refresh requested for {endpoint}")
+        return None
+    ttl = int(os.environ.get('SCHEMA_CACHE_TTL',86400))
+    cachefile = schema_cache_file(endpoint)
+    try:
+        age = time.time() - os.path.getmtime(cachefile)
+        if age > ttl:
+            logger.info(f"Schema cache expired for {endpoint}")
+            return None
+        with open(cachefile, encoding='utf-8') as f:
+            schema = build_schema(f.read())
+    except FileNotFoundError:
+        logger.info(f"Schema cache not found for {endpoint}")
+        schema = None
+    except Exception as e:
+        logger.error(f"Error Loading cached schema : {e}")
+        schema = None
+    else:
+        logger.info(f"Using cached schema for {endpoint}")
+    return schema
+
+def save_cached_schema(endpoint,schema):
+    import tempfile
+    from graphql import print_schema
+    cachefile = schema_cache_file(endpoint)
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        # write to a temporary file and rename so readers never see a partial schema
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(cachefile))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(print_schema(schema))
+        os.replace(tmpfile, cachefile)
+    except Exception as e:
+        logger.error(f"Error Saving cached schema : {e}")
+    else:
+        logger.info(f"Schema cached for {endpoint} on {cachefile}")
+
+# response cache
+class ResponseCache:
+    # cache of query results keyed by the printed query (normalized AST) and its variables
+    # entries expire after ttl seconds (per operation on ttls) and the least recently used are evicted above max_entries
+    # with path the entries are kept on a sqlite file shared by all processes using it
+    def __init__(self, max_entries=None, ttl=None, ttls=None, path=None):
+        if max_entries == None:
+            max_entries = int(os.environ.get('RESPONSE_CACHE_SIZE',1000))
+        if ttl == None:
+            ttl = float(os.environ.get('RESPONSE_CACHE_TTL',300))
+        if path == None:
+            path = os.environ.get('RESPONSE_CACHE_DB',None)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.path = path
+        self.codec = get_json_codec()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if path != None:
+            import sqlite3
+            self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, expires REAL, used REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+            self.entries = None
+        else:
+            self.db = None
+            self.entries = OrderedDict()
+
+    def key(self, query, variables):
+        from graphql import print_ast
+        printed = print_ast(query)
+        values = json.dumps(variables, sort_keys=True, separators=(',',':'))
+        return hashlib.sha256(f"{printed}\n{values}".encode('utf-8')).hexdigest()
+
+    def ttl_for(self, query):
+        from graphql import OperationDefinitionNode
+        for definition in query.definitions:
+            if isinstance(definition, OperationDefinitionNode) and definition.name != None:
+                return self.ttls.get(definition.name.value, self.ttl)
+        return self.ttl
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            if self.db != None:
+                row = self.db.execute(
+                    "SELECT value FROM responses WHERE key = ? AND expires > ?", (key, now)
+                ).fetchone()
+                if row != None:
+                    self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+                    value = self.codec.loads(row[0])
+                else:
+                    value = None
+            else:
+                entry = self.entries.get(key)
+                if entry != None and entry[0] <= now:
+                    del self.entries[key]
+                    entry = None
+                if entry != None:
+                    self.entries.move_to_end(key)
+                    value = self.codec.loads(entry[1])
+                else:
+                    value = None
+            if value != None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return value
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self.lock:
+            if self.db != None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                    (key, self.codec.dumps(value), now + ttl, now)
+                )
+                self.db.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+                self.db.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            else:
+                # stored encoded like on sqlite, so every get returns a copy the caller can change
+                self.entries[key] = (now + ttl, self.codec.dumps(value))
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            if self.db != None:
+                size = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            else:
+                size = len(self.entries)
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total > 0 else 0,
+            "size": size
+        }
+
+    def close(self):
+        if self.db != None:
+            self.db.close()
+
+def get_response_cache():
+    # export RESPONSE_CACHE='True' to enable the response cache
+    enabled = os.environ.get('RESPONSE_CACHE','False')
+    if enabled == "True" or enabled == "true":
+        return ResponseCache()
+    return None
+
+# result writers
+class ResultWriter:
+    # writes result nodes as they arrive instead of dumping the whole document at the end
+    def __init__(self, stream, codec=None, path=None):
+        self.stream = stream
+        self.codec = codec or get_json_codec()
+        self.path = path
+        self.count = 0
+
+    def write(self, node):
+        self.count += 1
+
+    def close(self):
+        self.stream.flush()
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+class NDJSONWriter(ResultWriter):
+    # one json document per line
+    def write(self, node):
+        self.stream.write(self.codec.dumps(node))
+        self.stream.write("\n")
+        self.count += 1
+
+class CSVWriter(ResultWriter):
+    # one row per node, nested objects are flattened as parent.child and lists are kept as json
+    # the header is taken from the first node, a node with columns missing from it starts a new part with all the columns
+    # nodes of different queries are better on their own writer (ResultWriters)
+    single_shape = True
+
+    def __init__(self, stream, codec=None, path=None):
+        super().__init__(stream, codec, path)
+        self.writer = None
+        self.parts = 0
+
+    def write(self, node):
+        import csv
+        row = flatten_node(node)
+        if self.writer == None:
+            self.writer = csv.DictWriter(self.stream, fieldnames=list(row), restval='')
+            self.writer.writeheader()
+        extra = [column for column in row if column not in self.writer.fieldnames]
+        if extra:
+            self.next_part(self.writer.fieldnames + extra)
+        self.writer.writerow(row)
+        self.count += 1
+
+    def next_part(self, columns):
+        # a null object on the first node or nodes of another type give new columns, the rows already written keep their header
+        # on a file the next rows go to <file without extension>.<part><extension>, on stdout after a blank line
+        import csv
+        self.parts += 1
+        if self.path != None:
+            self.stream.close()
+            base, extension = os.path.splitext(self.path)
+            path = f"{base}.{self.parts}{extension}"
+            self.stream = open(path, 'w', encoding='utf-8', newline='')
+            logger.warning(f"CSV columns changed, writing the next rows to {path}")
+        else:
+            self.stream.write("\n")
+        self.writer = csv.DictWriter(self.stream, fieldnames=columns, restval='')
+        self.writer.writeheader()
+
+def flatten_node(node, prefix=''):
+    row = {}
+    for key, value in node.items():
+        if isinstance(value, dict):
+            row.update(flatten_node(value, f"{prefix}{key}."))
+        elif isinstance(value, list):
+            row[f"{prefix}{key}"] = json.dumps(value, separators=(',',':'), ensure_ascii=False)
+        else:
+            row[f"{prefix}{key}"] = value
+    return row
+
+result_writers = {
+    'ndjson': NDJSONWriter,
+    'csv': CSVWriter
+}
+
+def open_result_writer(fmt, name=None):
+    # writer of fmt on OUTPUT_FILE, or stdout when it is not set, None when fmt is not streamed
+    # with name the file is <OUTPUT_FILE without extension>.<name><extension>
+    if fmt not in result_writers:
+        return None
+    path = os.environ.get('OUTPUT_FILE',None)
+    if path != None and name != None:
+        base, extension = os.path.splitext(path)
+        path = f"{base}.{name}{extension}"
+    if path != None:
+        stream = open(path, 'w', encoding='utf-8', newline='')
+    else:
+        stream = sys.stdout
+    return result_writers[fmt](stream, path=path)
+
+def get_result_writer():
+    # export OUTPUT_FORMAT='ndjson' or 'csv' to stream the results, OUTPUT_FILE to write them to a file instead of stdout
+    return open_result_writer(os.environ.get('OUTPUT_FORMAT','json'))
+
+def write_result(writer, result):
+    # every item of a list is written as its own node
+    for value in result.values():
+        if isinstance(value, list):
+            for node in value:
+                writer.write(node)
+        elif value != None:
+            writer.write(value)
+
+class ResultWriters:
+    # results of different queries on one output, every root field of the results is a shape
+    # formats with a fixed header (csv) get one writer per shape: OUTPUT_FILE='result.csv' is split on result.<shape>.csv
+    # and on stdout every shape is written with its own header, the others share a single writer
+    def __init__(self, fmt=None):
+        if fmt == None:
+            fmt = os.environ.get('OUTPUT_FORMAT','json')
+        self.fmt = fmt
+        self.writers = {}
+
+    def get(self, name):
+        if not getattr(result_writers[self.fmt], 'single_shape', False):
+            name = None
+        writer = self.writers.get(name)
+        if writer == None:
+            writer = open_result_writer(self.fmt, name)
+            self.writers[name] = writer
+        return writer
+
+    def write(self, name, node):
+        self.get(name).write(node)
+
+    def write_result(self, result):
+        for name, value in result.items():
+            if value != None:
+                write_result(self.get(name), {name: value})
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+def get_result_writers():
+    # export OUTPUT_FORMAT='ndjson' or 'csv' to stream the results, None to print them as json
+    fmt = os.environ.get('OUTPUT_FORMAT','json')
+    if fmt not in result_writers:
+        return None
+    return ResultWriters(fmt)
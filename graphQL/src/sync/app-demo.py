@@ -1,15 +1,36 @@
 import os
+import sys
 import json
 import urllib3
+import urllib3.connection
+import urllib3.util.connection
 import logging
 import http
+import requests
 from requests.auth import HTTPProxyAuth
 import socket
+import time
+import hashlib
+from collections import OrderedDict
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from graphql import ExecutionResult, validate
 from gql import Client, utilities
-from gql.dsl import DSLSchema, DSLQuery, DSLFragment, dsl_gql, print_ast
+from gql.dsl import DSLSchema, DSLQuery, DSLFragment, DSLVariableDefinitions, dsl_gql, print_ast
 from gql.transport.requests import RequestsHTTPTransport
 from gql.transport.requests import log as requests_logger
+from gql.transport.exceptions import TransportClosed, TransportProtocolError, TransportQueryError, TransportServerError
+
+# helpers shared with the other demo and githubGraphQL/app.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gql_helpers import (
+    get_request_metrics, instrument_validation, get_json_codec, accept_encoding,
+    RetryTransport, httpx_transport_args, load_cached_schema, save_cached_schema, get_response_cache,
+    get_result_writer, write_result
+)
 
 def config():
     # set keepalive
@@ -56,7 +77,282 @@ def set_logger():
 def print_to_log(*args):
     logger.debug(" ".join(args))
 
-def get_gql_transport(endpoint,access_token):
+# dns and connect times of the connection opened by the current thread
+connection_timings = threading.local()
+# metrics receiving the connection timings, replaced by every call of instrument_connections
+connection_metrics = None
+
+def instrument_connections(metrics):
+    # urllib3 has no hooks for the connection phases, so name resolution, connect and tls handshake are wrapped
+    # connections reused from the pool have no dns, connect or tls times
+    # urllib3 is patched once per process, the wrappers record on the metrics of the last call
+    global connection_metrics
+    connection_metrics = metrics
+    if getattr(urllib3.util.connection, 'instrumented', False):
+        return
+    resolver = urllib3.util.connection.socket
+    create_connection = urllib3.util.connection.create_connection
+    https_connect = urllib3.connection.HTTPSConnection.connect
+
+    class TimedResolver:
+        # urllib3 resolves names with socket.getaddrinfo, everything else comes from the socket module
+        def __getattr__(self, name):
+            return getattr(resolver, name)
+
+        def getaddrinfo(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return resolver.getaddrinfo(*args, **kwargs)
+            finally:
+                connection_timings.dns = time.perf_counter() - start
+
+    def timed_create_connection(*args, **kwargs):
+        connection_timings.dns = 0
+        start = time.perf_counter()
+        sock = create_connection(*args, **kwargs)
+        connection_timings.connect = time.perf_counter() - start
+        if connection_metrics != None:
+            connection_metrics.observe('dns', connection_timings.dns)
+            connection_metrics.observe('connect', connection_timings.connect - connection_timings.dns)
+        return sock
+
+    def timed_https_connect(self):
+        connection_timings.connect = 0
+        start = time.perf_counter()
+        https_connect(self)
+        if connection_metrics != None:
+            connection_metrics.observe('tls', time.perf_counter() - start - connection_timings.connect)
+
+    urllib3.util.connection.socket = TimedResolver()
+    urllib3.util.connection.create_connection = timed_create_connection
+    urllib3.connection.HTTPSConnection.connect = timed_https_connect
+    urllib3.util.connection.instrumented = True
+
+def get_response_hook(metrics):
+    # requests calls the hook when the headers arrive, before the body is downloaded
+    def record_response(response, *args, **kwargs):
+        ttfb = response.elapsed.total_seconds()
+        metrics.observe('ttfb', ttfb)
+        start = time.perf_counter()
+        response.content
+        download = time.perf_counter() - start
+        metrics.observe('download', download)
+        json_decode = response.json
+        def timed_json(**kwargs):
+            start = time.perf_counter()
+            try:
+                return json_decode(**kwargs)
+            finally:
+                metrics.observe('decode', time.perf_counter() - start)
+        response.json = timed_json
+        logger.debug(f"REQUEST TIMINGS: {response.url} status {response.status_code} ttfb {ttfb:.4f}s download {download:.4f}s")
+        return response
+    return record_response
+
+class CodecSession(requests.Session):
+    # requests session encoding json bodies and decoding the responses with a JSONCodec
+    def __init__(self, codec):
+        super().__init__()
+        self.codec = codec
+
+    def request(self, method, url, json=None, data=None, headers=None, hooks=None, **kwargs):
+        if json is not None:
+            data = self.codec.dumps(json).encode('utf-8')
+            headers = {**(headers or {}), "Content-Type": "application/json"}
+        # the codec goes first so the other response hooks (timings) see it
+        hooks = dict(hooks or {})
+        response_hooks = hooks.get("response") or []
+        if callable(response_hooks):
+            response_hooks = [response_hooks]
+        hooks["response"] = [self.decode_response] + list(response_hooks)
+        return super().request(method, url, data=data, headers=headers, hooks=hooks, **kwargs)
+
+    def decode_response(self, response, *args, **kwargs):
+        codec = self.codec
+        response.json = lambda **kwargs: codec.loads(response.content)
+        return response
+
+class ThreadLocalHeaders:
+    # the gql transports keep the headers of the last response on the instance
+    # with threads (execute_bulk) every thread keeps the headers of its own last response
+    @property
+    def thread_state(self):
+        return self.__dict__.setdefault('local', threading.local())
+
+    @property
+    def response_headers(self):
+        return getattr(self.thread_state, 'response_headers', None)
+
+    @response_headers.setter
+    def response_headers(self, headers):
+        self.thread_state.response_headers = headers
+
+class CodecTransport(ThreadLocalHeaders, RequestsHTTPTransport):
+    # requests transport sending and reading json with a JSONCodec (orjson, ujson or json)
+    # requests.Session is not thread safe, every thread gets its own session on first use
+    # the sessions share the adapters mounted on the transport, so the retries and the connection pools
+    def __init__(self, *args, json_codec=None, **kwargs):
+        self.adapters = None
+        super().__init__(*args, **kwargs)
+        self.json_codec = json_codec or get_json_codec()
+
+    @property
+    def session(self):
+        session = getattr(self.thread_state, 'session', None)
+        if session == None and self.adapters != None:
+            session = CodecSession(self.json_codec)
+            session.adapters = self.adapters
+            self.thread_state.session = session
+        return session
+
+    @session.setter
+    def session(self, session):
+        self.thread_state.session = session
+
+    def connect(self):
+        super().connect()
+        # keep the adapters mounted with the retries
+        self.adapters = self.session.adapters
+        self.session = None
+
+    def close(self):
+        super().close()
+        self.adapters = None
+
+def persisted_query_error(result):
+    # APQ servers answer with an error when they do not know the hash or do not support persisted queries
+    for error in result.get("errors") or []:
+        code = (error.get("extensions") or {}).get("code")
+        if error.get("message") == "PersistedQueryNotFound" or code == "PERSISTED_QUERY_NOT_FOUND":
+            return "PersistedQueryNotFound"
+        if error.get("message") == "PersistedQueryNotSupported" or code == "PERSISTED_QUERY_NOT_SUPPORTED":
+            return "PersistedQueryNotSupported"
+    return None
+
+def persisted_query_params(payload):
+    # on GET every field goes on the query string, objects as json
+    return {
+        key: value if isinstance(value, str) else json.dumps(value, separators=(',',':'))
+        for key, value in payload.items()
+    }
+
+class PersistedQueryTransport(CodecTransport):
+    # automatic persisted queries (APQ): the query is sent only as its sha256 hash and sent in full
+    # when the server answers PersistedQueryNotFound, with use_get the hashed requests can be cached by a CDN
+    def __init__(self, *args, use_get=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.use_get = use_get
+        self.persisted_supported = True
+        self.persisted_queries = OrderedDict()
+        self.persisted_lock = threading.Lock()
+
+    def persisted_query(self, document):
+        # the printed query and its hash are computed once per document
+        key = id(document)
+        with self.persisted_lock:
+            entry = self.persisted_queries.get(key)
+            if entry != None and entry[0] is document:
+                self.persisted_queries.move_to_end(key)
+                return entry[1], entry[2]
+        query_str = print_ast(document)
+        query_hash = hashlib.sha256(query_str.encode('utf-8')).hexdigest()
+        with self.persisted_lock:
+            self.persisted_queries[key] = (document, query_str, query_hash)
+            while len(self.persisted_queries) > 1000:
+                self.persisted_queries.popitem(last=False)
+        return query_str, query_hash
+
+    def execute(self, document, variable_values=None, operation_name=None, timeout=None, extra_args=None, upload_files=False):
+        if upload_files or not self.persisted_supported:
+            return super().execute(document, variable_values, operation_name, timeout, extra_args, upload_files)
+        query_str, query_hash = self.persisted_query(document)
+        payload = {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": query_hash}}}
+        if variable_values:
+            payload["variables"] = variable_values
+        if operation_name:
+            payload["operationName"] = operation_name
+        result = self.send_payload(payload, self.use_get, timeout, extra_args)
+        error = persisted_query_error(result)
+        if error == "PersistedQueryNotSupported":
+            logger.warning(f"Persisted queries not supported by {self.url}, sending full queries")
+            self.persisted_supported = False
+            return super().execute(document, variable_values, operation_name, timeout, extra_args)
+        if error == "PersistedQueryNotFound":
+            # register the query on the server, always with POST since the query may not fit on the url
+            logger.debug(f"Persisted query {query_hash} not found, sending full query")
+            payload["query"] = query_str
+            result = self.send_payload(payload, False, timeout, extra_args)
+        return ExecutionResult(
+            errors=result.get("errors"),
+            data=result.get("data"),
+            extensions=result.get("extensions")
+        )
+
+    def send_payload(self, payload, use_get, timeout, extra_args):
+        if self.session is None:
+            raise TransportClosed("Transport is not connected")
+        request_args = {
+            "headers": self.headers,
+            "auth": self.auth,
+            "cookies": self.cookies,
+            "timeout": timeout or self.default_timeout,
+            "verify": self.verify
+        }
+        if use_get:
+            method = 'GET'
+            request_args["params"] = persisted_query_params(payload)
+        else:
+            method = 'POST'
+            request_args["json"] = payload
+        request_args.update(self.kwargs)
+        if extra_args:
+            request_args.update(extra_args)
+        response = self.session.request(method, self.url, **request_args)
+        self.response_headers = response.headers
+        try:
+            result = response.json()
+        except Exception:
+            try:
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                raise TransportServerError(str(e), e.response.status_code) from e
+            raise TransportProtocolError(f"Server did not return a GraphQL result: Not a JSON answer: {response.text}")
+        if "errors" not in result and "data" not in result:
+            raise TransportProtocolError(f"Server did not return a GraphQL result: No \"data\" or \"errors\" keys in answer: {response.text}")
+        return result
+
+# httpx
+def get_codec_hook(codec):
+    # httpx response hook decoding response.json() with codec
+    def decode_response(response):
+        response.json = lambda **kwargs: codec.loads(response.content)
+    return decode_response
+
+def get_httpx_transport(endpoint,headers,certverify,retries,timeout,metrics=None):
+    # HTTPX transport, with HTTP/2 the concurrent queries of execute_bulk share one multiplexed connection
+    import httpx
+    from gql.transport.httpx import HTTPXTransport
+    if metrics != None:
+        logger.warning("Request timings are recorded only with the requests transport")
+    if os.environ.get('PERSISTED_QUERIES','False') in ("True", "true"):
+        logger.warning("Persisted queries are sent only with the requests transport")
+    codec = get_json_codec()
+
+    class ThreadLocalHTTPXTransport(ThreadLocalHeaders, HTTPXTransport):
+        # the httpx client and its connections are thread safe and shared by the threads
+        pass
+
+    return ThreadLocalHTTPXTransport(
+        url=endpoint,
+        headers=headers,
+        timeout=timeout,
+        json_serialize=codec.dumps,
+        transport=RetryTransport(httpx.HTTPTransport(**httpx_transport_args(endpoint, certverify, retries)), retries),
+        event_hooks={"response": [get_codec_hook(codec)]},
+        trust_env=False
+    )
+
+def get_gql_transport(endpoint,access_token,metrics=None):
     # certificate
     cert = os.environ.get('CERTIFICATE',None)
     if cert == None:
@@ -66,20 +362,36 @@ def get_gql_transport(endpoint,access_token):
         urllib3.disable_warnings()
     else:
         certverify = cert
+    headers={"Accept-Encoding": accept_encoding()}
     if access_token !=None:
-        headers={"Authorization": f"Bearer {access_token}"}
+        headers["Authorization"] = f"Bearer {access_token}"
+    # export GQL_TRANSPORT='httpx' to use HTTPX with HTTP/2 instead of requests
+    if os.environ.get('GQL_TRANSPORT','requests') == 'httpx':
+        return get_httpx_transport(endpoint, headers, certverify, 15, 120, metrics)
+    # record the request timings on metrics
+    transport_args = {}
+    if metrics != None:
+        instrument_connections(metrics)
+        transport_args["hooks"] = {"response": [get_response_hook(metrics)]}
+    # export PERSISTED_QUERIES='True' to send the queries as automatic persisted queries
+    persisted = os.environ.get('PERSISTED_QUERIES','False')
+    if persisted == "True" or persisted == "true":
+        use_get = os.environ.get('PERSISTED_QUERIES_GET','False')
+        transport_args["use_get"] = use_get == "True" or use_get == "true"
+        transport_class = PersistedQueryTransport
     else:
-        headers=None
+        transport_class = CodecTransport
     # Set up the HTTP transport with your access token
     # https://gql.readthedocs.io/en/latest/modules/transport_requests.html
-    transport = RequestsHTTPTransport(
+    transport = transport_class(
         url=endpoint,
         headers=headers,
         verify=certverify,
         retries=15,
         timeout=120,
         method='POST',
-        use_json=True
+        use_json=True,
+        **transport_args
     )
     # set proxy different from environment
     prox = os.environ.get('SET_PROXY',None)
@@ -98,10 +410,49 @@ def get_gql_transport(endpoint,access_token):
         transport.auth = proxyauth
     return transport
 
+query_templates = {}
+
+def get_query_template(ds,name,schema):
+    # schema is the schema of the client (gqlclient.schema) the templates are validated against
+    if name in query_templates:
+        return query_templates[name]
+    builders = {
+        'GetContinents': query_continents,
+        'GetCountryByCode': query_contry_by_code,
+        'GetCountriesonContinent': query_contries_on_continent
+    }
+    query = builders[name](ds)
+    if query != "Failed":
+        errors = validate(schema, query)
+        if errors:
+            logger.error(f"Error Validating query {name} : {errors[0]}")
+            query = "Failed"
+        else:
+            logger.info(f"Compiled query template {name}")
+            query_templates[name] = query
+    return query
+
+def skip_template_validation(gqlclient):
+    # templates were validated when compiled, gql does not need to validate them on every execute
+    # batch documents are validated the first time they are sent
+    validate_document = gqlclient.validate
+    validated = set()
+    def validate_once(document):
+        for template in query_templates.values():
+            if document is template:
+                return
+        if id(document) in validated:
+            return
+        validate_document(document)
+        for template in batch_templates.values():
+            if document is template:
+                validated.add(id(document))
+    gqlclient.validate = validate_once
+
 def query_continents(ds):
     try:
         query = dsl_gql(
-            DSLQuery(
+            GetContinents=DSLQuery(
                 GetContinents=ds.Query.continents.select(
                     ds.Continent.code,
                     ds.Continent.name
@@ -114,38 +465,163 @@ def query_continents(ds):
     # else:
     return query
 
-def query_contry_by_code(ds,code):
+def country_selection(ds):
+    # fields selected for a country, shared by the single and batched lookups
+    return (
+        ds.Country.continent.select(
+            ds.Continent.name
+        ),
+        ds.Country.name,
+        ds.Country.capital,
+        ds.Country.currency,
+        ds.Country.languages.select(
+            ds.Language.code,
+            ds.Language.name
+        )
+    )
+
+def query_contry_by_code(ds):
     try:
-        class DSLVariableDefinitions:
-            countrycode = code
+        # variables: {"code": "IE"}
+        var = DSLVariableDefinitions()
+        query_by_code = DSLQuery(
+            GetCountryByCode=ds.Query.country.args(
+                code=var.code
+            ).select(
+                *country_selection(ds)
+            )
+        )
+        query_by_code.variable_definitions = var
         query = dsl_gql(
-            DSLQuery(
-                GetCountryByCode=ds.Query.country.args(
-                    code=DSLVariableDefinitions.countrycode
-                ).select(
-                    ds.Country.continent.select(
-                        ds.Continent.name
-                    ),
-                    ds.Country.name,
-                    ds.Country.capital,
-                    ds.Country.currency,
-                    ds.Country.languages.select(
-                        ds.Language.code,
-                        ds.Language.name
-                    )
+            GetCountryByCode=query_by_code
+        )
+    except Exception as e:
+        logger.error(f"Error Generating query : {e}")
+        query = "Failed"
+    # else:
+    return query
+
+# batch queries by number of lookups, batches of the same size send the same document with other variables
+# so it is validated once and keeps the same persisted query hash
+batch_templates = {}
+
+def query_countries_by_codes(ds,count):
+    # one aliased field per country with its own variable, e.g. c0: country(code: $c0) {...}
+    # variables: {"c0": "IE", "c1": "PT"}
+    if count in batch_templates:
+        return batch_templates[count]
+    try:
+        var = DSLVariableDefinitions()
+        fields = []
+        for index in range(count):
+            fields.append(
+                ds.Query.country.args(
+                    code=getattr(var, f"c{index}")
+                ).alias(f"c{index}").select(
+                    *country_selection(ds)
                 )
             )
+        query_by_codes = DSLQuery(*fields)
+        query_by_codes.variable_definitions = var
+        query = dsl_gql(
+            GetCountriesByCodes=query_by_codes
         )
     except Exception as e:
         logger.error(f"Error Generating query : {e}")
         query = "Failed"
-    # else:
+    else:
+        batch_templates[count] = query
     return query
 
-def query_contries_on_continent(ds,code):
+class CountryBatchLoader:
+    # collects country lookups and sends them as a single aliased query
+    # a batch is sent when it reaches batch_max lookups or batch_interval seconds after the first one
+    def __init__(self, ds, session, batch_max=None, batch_interval=None):
+        self.ds = ds
+        self.session = session
+        if batch_max == None:
+            batch_max = int(os.environ.get('BATCH_MAX',50))
+        if batch_interval == None:
+            batch_interval = float(os.environ.get('BATCH_INTERVAL',0.01))
+        self.batch_max = batch_max
+        self.batch_interval = batch_interval
+        self.pending = {}
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def load(self, code):
+        # returns a future with the country, repeated codes share the same lookup
+        batch = None
+        with self.lock:
+            if code in self.pending:
+                return self.pending[code]
+            future = Future()
+            self.pending[code] = future
+            if len(self.pending) >= self.batch_max:
+                batch = self.take_pending()
+            elif self.timer == None:
+                self.timer = threading.Timer(self.batch_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if batch != None:
+            self.dispatch(batch)
+        return future
+
+    def load_many(self, codes):
+        futures = [self.load(code) for code in codes]
+        self.flush()
+        return [future.result() for future in futures]
+
+    def flush(self):
+        with self.lock:
+            batch = self.take_pending()
+        if batch:
+            self.dispatch(batch)
+
+    def take_pending(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.pending
+        self.pending = {}
+        return batch
+
+    def dispatch(self, batch):
+        logger.info(f"Executing batch of {len(batch)} country lookups")
+        query = query_countries_by_codes(self.ds, len(batch))
+        # the alias and the variable of every lookup are both c<index>
+        variables = {f"c{index}": code for index, code in enumerate(batch)}
+        if query == "Failed":
+            for future in batch.values():
+                future.set_exception(ValueError("Error Generating batch query"))
+            return
+        errors = {}
+        try:
+            data = self.session.execute(query, variable_values=variables)
+        except TransportQueryError as e:
+            # split partial errors back to the lookups that caused them
+            data = e.data or {}
+            for error in e.errors or []:
+                path = error.get('path') or [None]
+                errors[path[0]] = error.get('message')
+            if None in errors:
+                data = {}
+        except Exception as e:
+            logger.error(f"Error Executing batch query : {e}")
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for alias, code in variables.items():
+            if alias in errors or alias not in data:
+                message = errors.get(alias, errors.get(None, "no data returned"))
+                batch[code].set_exception(TransportQueryError(f"Error on country {code}: {message}"))
+            else:
+                batch[code].set_result(data[alias])
+
+def query_contries_on_continent(ds):
     try:
-        class DSLVariableDefinitions:
-            continentcode = code
+        # variables: {"code": "OC"}
+        var = DSLVariableDefinitions()
         countryinfo = DSLFragment("CountryInfo")
         countryinfo.on(ds.Country)
         countryinfo.select(
@@ -156,7 +632,7 @@ def query_contries_on_continent(ds,code):
         )
         query_with_fragment = DSLQuery(
             GetCountriesonContinent=ds.Query.continent.args(
-                code=DSLVariableDefinitions.continentcode
+                code=var.code
             ).select(
                 ds.Continent.code,
                 ds.Continent.name,
@@ -165,9 +641,10 @@ def query_contries_on_continent(ds,code):
                 )
             )
         )
+        query_with_fragment.variable_definitions = var
         query = dsl_gql(
             countryinfo,
-            query_with_fragment
+            GetCountriesonContinent=query_with_fragment
         )
     except Exception as e:
         logger.error(f"Error Generating query : {e}")
@@ -175,21 +652,88 @@ def query_contries_on_continent(ds,code):
     # else:
     return query
 
-def execute_query(query, session):
+def execute_query(query, session, variables=None, cache=None, ttl=None):
+    if cache != None:
+        key = cache.key(query, variables)
+        result = cache.get(key)
+        if result != None:
+            return result
     # Execute the query
     try:
-        result = session.execute(query)
+        result = session.execute(query, variable_values=variables)
     except Exception as e:
-        logger.error(f"Error Executing query : {e}\nError: {json.dumps(result['errors'])}\nHeaders: {result['headers']}")
+        logger.error(f"Error Executing query : {e}\nError: {json.dumps(getattr(e, 'errors', None))}")
         result = "Failed"
+    else:
+        if cache != None:
+            cache.set(key, result, ttl if ttl != None else cache.ttl_for(query))
     return result
 
+def size_connection_pool(transport, workers):
+    # requests keeps at most 10 connections per host (pool_maxsize), more workers would open and drop connections
+    # mount an adapter sized to the workers keeping the same retries of the transport
+    # httpx has its own limits (100 connections, or one multiplexed connection with HTTP/2)
+    if getattr(transport, 'session', None) == None:
+        return
+    adapter = transport.session.get_adapter(transport.url)
+    if getattr(adapter, '_pool_maxsize', 0) >= workers:
+        return
+    logger.info(f"Sizing connection pool to {workers} connections")
+    adapter = HTTPAdapter(
+        pool_maxsize=workers,
+        max_retries=Retry(
+            total=transport.retries,
+            backoff_factor=transport.retry_backoff_factor,
+            status_forcelist=transport.retry_status_forcelist,
+            allowed_methods=None
+        )
+    )
+    for prefix in "http://", "https://":
+        transport.session.mount(prefix, adapter)
+
+def execute_bulk(jobs, session, workers=None, cache=None):
+    # run a list of (query, variables) jobs on a thread pool sharing the connection pool of the session
+    # the requests transports give every thread its own requests.Session and response headers (CodecTransport)
+    # results keep the jobs order and a failed job returns "Failed" without stopping the others
+    if workers == None:
+        workers = int(os.environ.get('MAX_WORKERS',10))
+    size_connection_pool(session.transport, workers)
+    logger.info(f"Executing {len(jobs)} gql queries with {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda job: execute_query(job[0], session, job[1], cache),
+            jobs
+        ))
+    failed = sum(1 for result in results if result == "Failed")
+    if failed > 0:
+        logger.error(f"{failed} of {len(jobs)} gql queries failed")
+    return results
+
 #################################### variables on Environment #####################################################################
 # export USR='username' # proxy username authentication
 # export PSW='password'
 # export SET_PROXY='http://my.proxy. com: 3128'
 # export CERTIFICATE='False'
 # export LOG_LEVEL='INFO' # use DEBUG to log schema, queries and http request/responses
+# export SCHEMA_CACHE_DIR='.schema_cache' # directory for the introspection schema cache
+# export SCHEMA_CACHE_TTL='86400' # seconds before the cached schema is fetched again
+# export SCHEMA_REFRESH='False' # use True to ignore the cached schema and refresh it
+# export BATCH_MAX='50' # maximum lookups merged in a single aliased query
+# export BATCH_INTERVAL='0.01' # seconds to wait for more lookups before sending a batch
+# export RESPONSE_CACHE='False' # use True to cache query results
+# export RESPONSE_CACHE_SIZE='1000' # maximum cached results
+# export RESPONSE_CACHE_TTL='300' # seconds a cached result is valid
+# export RESPONSE_CACHE_DB='responses.db' # sqlite file to share the cache between processes, in memory when not set
+# export OUTPUT_FORMAT='json' # use ndjson or csv to stream the result nodes
+# export OUTPUT_FILE='result.ndjson' # write the results to a file instead of stdout
+# export METRICS_FILE='metrics.prom' # record dns, connect, tls, ttfb, download, decode and validation times (.json for json)
+# export PERSISTED_QUERIES='False' # use True to send queries as automatic persisted queries (sha256 hash)
+# export PERSISTED_QUERIES_GET='False' # use True to send the hashed queries with GET so a CDN can cache them
+# export JSON_CODEC='auto' # orjson, ujson or json to encode and decode the requests, auto uses the first installed
+# export ACCEPT_ENCODING='gzip, br' # compressed responses, br only when brotli is installed
+# export GQL_TRANSPORT='requests' # use httpx to send the queries with HTTPX
+# export HTTP2='True' # HTTP/2 with httpx, needs pip install httpx[http2]
+# export MAX_WORKERS='10' # threads used by execute_bulk
 ###################################################################################################################################
 
 if __name__ == "__main__":
@@ -197,10 +741,17 @@ if __name__ == "__main__":
     logger = set_logger()
     endpoint = "https://countries.trevorblades.com/graphql"
     # Get transport
-    transport = get_gql_transport(endpoint,None)
+    metrics = get_request_metrics()
+    transport = get_gql_transport(endpoint,None,metrics)
+    # use the cached schema when available instead of introspection
+    cached_schema = load_cached_schema(endpoint)
+    response_cache = get_response_cache()
     try:
-        # establish connection and fetch schema using introspection
-        gqlclient = Client(transport=transport, fetch_schema_from_transport=True)
+        if cached_schema != None:
+            gqlclient = Client(transport=transport, schema=cached_schema)
+        else:
+            # establish connection and fetch schema using introspection
+            gqlclient = Client(transport=transport, fetch_schema_from_transport=True)
     except Exception as e:
         logger.error(f"Error Getting client: {e}")
         transport.close()
@@ -208,32 +759,51 @@ if __name__ == "__main__":
         try:
             with gqlclient as session:
                 assert gqlclient.schema is not None
+                if cached_schema == None:
+                    save_cached_schema(endpoint,gqlclient.schema)
                 schema = utilities.get_introspection_query_ast(gqlclient.schema)
                 logger.debug(f"SCHEMA: {print_ast(schema)}")
                 # Instantiate the root of the DSL Schema as ds
                 ds = DSLSchema(gqlclient.schema)
+                skip_template_validation(gqlclient)
+                if metrics != None:
+                    instrument_validation(gqlclient, metrics)
                 # simple query
-                # query = query_continents(ds)
+                # query = get_query_template(ds,'GetContinents',gqlclient.schema)
+                # variables = None
                 # query with variables
                 # countrycode="IE"
-                # query = query_contry_by_code(ds,countrycode)
+                # query = get_query_template(ds,'GetCountryByCode',gqlclient.schema)
+                # variables = {"code": countrycode}
                 # query with fragment
                 continentcode = 'EU'
-                query=query_contries_on_continent(ds,continentcode)
+                query = get_query_template(ds,'GetCountriesonContinent',gqlclient.schema)
+                variables = {"code": continentcode}
                 if query == "Failed":
                     gqlclient.close_sync()
                     transport.close()
                 else:
-                    logger.debug(f"QUERY DATA: {print_ast(query)}")
-                    result = execute_query(query, session)
+                    logger.debug(f"QUERY DATA: {print_ast(query)}\nVARIABLES: {json.dumps(variables)}")
+                    result = execute_query(query, session, variables, response_cache)
                     if query == "Failed":
                         gqlclient.close_sync()
                         transport.close()
                     else:
-                        logger.debug(f"Success : {json.dumps(result)}")
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug(f"Success : {json.dumps(result)}")
         except Exception as e:
             logger.error(f"Error on client: {e}")
             gqlclient.close_sync()
         finally:
             transport.close()
-            print(f"Result: {json.dumps(result,indent=2)}")
+            if response_cache != None:
+                logger.info(f"Response cache: {json.dumps(response_cache.stats())}")
+                response_cache.close()
+            if metrics != None:
+                metrics.export(os.environ.get('METRICS_FILE'))
+            writer = get_result_writer()
+            if writer == None:
+                print(f"Result: {json.dumps(result,indent=2)}")
+            elif result != "Failed":
+                write_result(writer, result)
+                writer.close()